@@ -0,0 +1,78 @@
+"""志望校ごとの成績集計 (成績結果・分析ページ用)
+
+Streamlitに依存しないpandasのみの処理で、ページが表示する値を
+groupby/aggの1回の集計でまとめて求める。ページ側は結果を描画するだけにする。
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+SCORE_COLUMNS = ["SchoolName", "TestName", "TestDate", "Subject", "Score", "MaxScore"]
+
+@dataclass
+class SubjectTrend:
+    """1科目の得点推移 (実施日順)"""
+    subject: str
+    scores: List[float]
+    mean: float
+    maximum: float
+    minimum: float
+    latest: float
+    change: float  # 初回からの増減
+
+@dataclass
+class SchoolAnalysis:
+    """1志望校分の集計結果"""
+    test_count: int
+    latest_test: Optional[str]
+    average_percentage: float
+    test_summary: pd.DataFrame  # TestName, TestDate, Score, MaxScore, Percentage (実施日の昇順)
+    latest_breakdown: pd.DataFrame  # 最新テストの Subject, Score, MaxScore, Percentage
+    subject_trends: Dict[str, SubjectTrend]  # 最新テストの科目のみ
+    test_order: List[str]  # 実施日の降順
+    rows: pd.DataFrame  # 元の得点行 (Percentage付き)
+    row_positions: Dict[str, np.ndarray]  # テスト名 -> rows 内の行位置
+
+    def test_rows(self, test_name: str) -> pd.DataFrame:
+        """1テスト分の科目ごとの行"""
+        return self.rows.iloc[self.row_positions[test_name]]
+
+def percentage(score, max_score):
+    """得点率 (%) をベクトル演算で計算 (満点が0以下なら0)"""
+    score = np.asarray(score, dtype=float); max_score = np.asarray(max_score, dtype=float)
+    out = np.zeros(np.broadcast(score, max_score).shape)
+    np.divide(score * 100, max_score, out=out, where=max_score > 0)
+    return out
+
+def analyze_school(school_data: pd.DataFrame) -> SchoolAnalysis:
+    """1志望校分の得点行 (SCORE_COLUMNS) を集計"""
+    df = school_data.copy()
+    df["Score"] = pd.to_numeric(df["Score"], errors="coerce").astype(float); df["MaxScore"] = pd.to_numeric(df["MaxScore"], errors="coerce").astype(float)
+    df["Percentage"] = percentage(df["Score"].to_numpy(), df["MaxScore"].to_numpy())
+    if df.empty:
+        empty_summary = pd.DataFrame(columns=["TestName", "TestDate", "Score", "MaxScore", "Percentage"])
+        return SchoolAnalysis(0, None, 0.0, empty_summary, df[["Subject", "Score", "MaxScore", "Percentage"]], {}, [], df, {})
+
+    # テストごとの合計
+    totals = df.groupby("TestName").agg(TestDate=("TestDate", "first"), Score=("Score", "sum"), MaxScore=("MaxScore", "sum")).reset_index()
+    totals["Percentage"] = percentage(totals["Score"].to_numpy(), totals["MaxScore"].to_numpy())
+    test_summary = totals.sort_values("TestDate", kind="stable").reset_index(drop=True)
+
+    # 実施日の降順 (同日は元の並び順)
+    newest_first = df.sort_values("TestDate", ascending=False, kind="stable")
+    test_order = newest_first["TestName"].drop_duplicates().tolist()
+    latest_test = test_order[0]
+    latest_breakdown = df.loc[df["TestName"] == latest_test, ["Subject", "Score", "MaxScore", "Percentage"]].reset_index(drop=True)
+
+    # 科目ごとの推移と統計量
+    oldest_first = df.sort_values("TestDate", kind="stable")
+    by_subject = oldest_first[oldest_first["Subject"].isin(latest_breakdown["Subject"])].groupby("Subject", sort=False)["Score"]
+    stats = by_subject.agg(["mean", "max", "min", "first", "last"]); histories = by_subject.agg(list)
+    subject_trends = {subject: SubjectTrend(subject, histories[subject], row["mean"], row["max"], row["min"], row["last"], row["last"] - row["first"]) for subject, row in stats.iterrows()}
+
+    return SchoolAnalysis(
+        test_count=len(totals), latest_test=latest_test, average_percentage=float(totals["Percentage"].mean()),
+        test_summary=test_summary, latest_breakdown=latest_breakdown, subject_trends=subject_trends,
+        test_order=test_order, rows=df, row_positions=df.groupby("TestName", sort=False).indices,
+    )
@@ -0,0 +1,27 @@
+"""ベンチマーク用の合成ユーザーデータ生成"""
+import datetime
+import numpy as np
+import pandas as pd
+
+def generate_user(n_schools: int, n_tests: int, seed: int = 0):
+    """志望校 n_schools 校 × 各 n_tests 回分のテスト結果を生成
+
+    各志望校は ALL_SUBJECTS から3〜7科目を選び、満点は50/100/200点から選ぶ。
+    戻り値はページが扱うのと同じ行形式の (schools_df, scores_df)。
+    """
+    from streamlit_app import ALL_SUBJECTS
+    rng = np.random.default_rng(seed)
+    schools, scores = [], []
+    start = datetime.date(2020, 4, 1)
+    for s in range(n_schools):
+        picked = sorted(rng.choice(len(ALL_SUBJECTS), size=int(rng.integers(3, 8)), replace=False))
+        subjects = [ALL_SUBJECTS[i] for i in picked]; max_scores = [float(rng.choice([50, 100, 200])) for _ in subjects]
+        school_name = f"志望校{s + 1}"
+        schools.append({"SchoolName": school_name, "Subjects": subjects, "MaxScores": max_scores})
+        skill = rng.uniform(0.3, 0.9, size=len(subjects))
+        for t in range(n_tests):
+            test_date = str(start + datetime.timedelta(days=7 * t))
+            ratios = np.clip(skill + rng.normal(0.002 * t, 0.1, size=len(subjects)), 0, 1)
+            for subject, max_score, ratio in zip(subjects, max_scores, ratios):
+                scores.append({"SchoolName": school_name, "TestName": f"第{t + 1}回模試", "TestDate": test_date, "Subject": subject, "Score": float(np.round(ratio * max_score * 2) / 2), "MaxScore": max_score})
+    return pd.DataFrame(schools), pd.DataFrame(scores, columns=["SchoolName", "TestName", "TestDate", "Subject", "Score", "MaxScore"])
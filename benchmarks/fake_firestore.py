@@ -0,0 +1,182 @@
+"""ベンチマーク用のメモリ上の疑似Firestore
+
+FirestoreManager が使う google.cloud.firestore.Client の範囲だけを実装し、
+ネットワーク往復回数と読み書きしたドキュメント数を数える。
+"""
+import copy
+import operator
+import threading
+import uuid
+from collections import OrderedDict
+
+BATCH_LIMIT = 500
+OPERATORS = {"==": operator.eq, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+class Counters:
+    """往復回数・読み込み数・書き込み数"""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.round_trips = 0; self.docs_read = 0; self.docs_written = 0
+
+    def as_dict(self) -> dict:
+        return {"round_trips": self.round_trips, "docs_read": self.docs_read, "docs_written": self.docs_written}
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference; self.id = reference.id; self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+class FakeDocumentReference:
+    def __init__(self, client, path: tuple, doc_id: str):
+        self._client = client; self._path = path; self.id = doc_id
+
+    def _docs(self) -> OrderedDict:
+        return self._client._store.setdefault(self._path, OrderedDict())
+
+    def get(self) -> FakeSnapshot:
+        self._client.counters.round_trips += 1; self._client.counters.docs_read += 1
+        return FakeSnapshot(self, self._docs().get(self.id))
+
+    def set(self, data: dict, merge: bool = False):
+        self._client.counters.round_trips += 1
+        self._apply_set(data, merge)
+
+    def delete(self):
+        self._client.counters.round_trips += 1
+        self._apply_delete()
+
+    def _apply_set(self, data: dict, merge: bool):
+        self._client.counters.docs_written += 1
+        docs = self._docs()
+        docs[self.id] = {**docs.get(self.id, {}), **copy.deepcopy(data)} if merge else copy.deepcopy(data)
+
+    def _apply_delete(self):
+        self._client.counters.docs_written += 1
+        self._docs().pop(self.id, None)
+
+class FakeQuery:
+    """where / order_by / start_after / limit を保持するクエリ (評価はstream時)"""
+    def __init__(self, client, path: tuple, filters=(), orders=(), cursor=None, limit_count=None):
+        self._client = client; self._path = path
+        self._filters = tuple(filters); self._orders = tuple(orders); self._cursor = cursor; self._limit = limit_count
+
+    def _copy(self, **changes):
+        state = {"filters": self._filters, "orders": self._orders, "cursor": self._cursor, "limit_count": self._limit, **changes}
+        return FakeQuery(self._client, self._path, **state)
+
+    def where(self, filter):
+        return self._copy(filters=self._filters + ((filter.field_path, filter.op_string, filter.value),))
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def start_after(self, document_fields: dict):
+        return self._copy(cursor=document_fields)
+
+    def limit(self, count: int):
+        return self._copy(limit_count=count)
+
+    def select(self, field_paths):
+        """取得するフィールドの指定 (疑似実装では件数の計測に影響しないため無視する)"""
+        return self._copy()
+
+    def document(self, doc_id: str = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, self._path, doc_id or uuid.uuid4().hex)
+
+    def _matches(self) -> list:
+        items = list(self._client._store.get(self._path, OrderedDict()).items())
+        items = [(doc_id, data) for doc_id, data in items if all(field in data and OPERATORS[op](data[field], value) for field, op, value in self._filters)]
+        if self._orders:
+            fields = [field for field, _ in self._orders if field != "__name__"]
+            items = [(doc_id, data) for doc_id, data in items if all(f in data for f in fields)]
+            descending = self._orders[0][1] == "DESCENDING"
+            sort_key = lambda item: tuple(item[0] if field == "__name__" else item[1][field] for field, _ in self._orders)
+            items.sort(key=sort_key, reverse=descending)
+            if self._cursor is not None:
+                cursor = tuple(self._cursor[field] for field, _ in self._orders)
+                items = [item for item in items if (sort_key(item) < cursor if descending else sort_key(item) > cursor)]
+        return items[:self._limit] if self._limit is not None else items
+
+    def stream(self):
+        self._client.counters.round_trips += 1
+        docs = self._matches()
+        self._client.counters.docs_read += len(docs)
+        for doc_id, data in docs: yield FakeSnapshot(self.document(doc_id), copy.deepcopy(data))
+
+class FakeCollectionReference(FakeQuery):
+    """コレクション (条件なしのクエリ)"""
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client; self._ops = []
+
+    def set(self, reference: FakeDocumentReference, data: dict, merge: bool = False):
+        self._ops.append((reference, data, merge))
+
+    def delete(self, reference: FakeDocumentReference):
+        self._ops.append((reference, None, False))
+
+    def commit(self):
+        if len(self._ops) > BATCH_LIMIT: raise ValueError(f"maximum {BATCH_LIMIT} writes allowed per request")
+        # 削除は複数スレッドから並行してコミットされるためロックで保護する
+        with self._client.lock:
+            self._client.counters.round_trips += 1
+            for reference, data, merge in self._ops:
+                if data is None: reference._apply_delete()
+                else: reference._apply_set(data, merge)
+        self._ops = []
+
+class FakeTransaction(FakeWriteBatch):
+    """トランザクション (google.cloud.firestore.transactional が呼ぶ範囲)
+
+    読み込みは即座に行い、書き込みは _commit でまとめて適用する (競合の検出は行わない)。
+    """
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, client):
+        super().__init__(client); self._id = None
+
+    def _clean_up(self):
+        self._ops = []; self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().hex
+
+    def _commit(self):
+        self.commit(); self._clean_up()
+
+    def _rollback(self):
+        self._clean_up()
+
+    def get_all(self, references):
+        return self._client.get_all(references)
+
+    def get(self, query):
+        return query.stream()
+
+class FakeFirestoreClient:
+    """google.cloud.firestore.Client の代わりに FirestoreManager(db=...) へ渡す"""
+    def __init__(self):
+        self._store = {}  # コレクションのパス -> {ドキュメントID: データ}
+        self.counters = Counters()
+        self.lock = threading.Lock()
+
+    def collection(self, *path) -> FakeCollectionReference:
+        return FakeCollectionReference(self, tuple(path))
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, references):
+        """複数ドキュメントの一括取得 (存在しないドキュメントも1件の読み込みとして数える)"""
+        self.counters.round_trips += 1; self.counters.docs_read += len(references)
+        for reference in references: yield FakeSnapshot(reference, copy.deepcopy(reference._docs().get(reference.id)))
@@ -0,0 +1,149 @@
+"""ベンチマークの実行
+
+リポジトリのルートで実行する:
+
+    python -m benchmarks.run --sizes 1x10,3x50,5x200 --output bench.json
+    python -m benchmarks.run --compare bench.json
+
+シナリオごとにレイテンシ・読み書きドキュメント数・往復回数・ピークメモリを計測し、
+JSONに保存する。--compare を指定すると保存済みの結果と比較し、悪化があれば終了コード1を返す。
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+# streamlit run 以外での import 時に出る警告を抑える
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+from analytics import SCORE_COLUMNS, analyze_school
+from benchmarks.datagen import generate_user
+from benchmarks.fake_firestore import FakeFirestoreClient
+import streamlit_app
+from streamlit_app import FirestoreManager, create_radar_chart_html, create_trend_chart_html
+
+USER_ID = "bench-user"
+
+def seeded_client(schools_df: pd.DataFrame, scores_df: pd.DataFrame) -> FakeFirestoreClient:
+    """データとサマリーを書き込み済みの疑似Firestoreを作る (カウンタは0に戻す)"""
+    client = FakeFirestoreClient()
+    manager = FirestoreManager(None, None, USER_ID, db=client)
+    manager.save_df_to_collection(schools_df, "schools"); manager.save_df_to_collection(scores_df, "scores")
+    manager.rebuild_stats()
+    client.counters.reset()
+    return client
+
+def build_scenarios(schools_df: pd.DataFrame, scores_df: pd.DataFrame) -> dict:
+    """シナリオ名 -> (setup, run)。setup は毎回新しい状態を作り、run がその状態で計測対象を実行する"""
+    school_name = schools_df["SchoolName"].iloc[0]
+    school_data = scores_df[scores_df["SchoolName"] == school_name]
+    analysis = analyze_school(school_data)
+    new_test = school_data[school_data["TestName"] == analysis.latest_test].assign(TestName="ベンチマーク追加模試", TestDate="2099-01-01")
+
+    def fresh_manager():
+        client = seeded_client(schools_df, scores_df)
+        return client, FirestoreManager(None, None, USER_ID, db=client)
+
+    def warm_manager():
+        client, manager = fresh_manager()
+        manager.read_collection_to_df("scores", SCORE_COLUMNS); manager.read_stats()
+        client.counters.reset()
+        return client, manager
+
+    no_state = lambda: (None, None)
+
+    def cold_charts():
+        streamlit_app._chart_cache.clear()
+        return None, None
+
+    render_trend = lambda ctx: create_trend_chart_html(analysis.test_summary["TestName"].tolist(), analysis.test_summary["Percentage"].tolist())
+    return {
+        "cold_read_scores": (fresh_manager, lambda ctx: ctx[1].read_collection_to_df("scores", SCORE_COLUMNS)),
+        "read_one_school": (fresh_manager, lambda ctx: ctx[1].read_collection_to_df("scores", SCORE_COLUMNS, [("SchoolName", "==", school_name)])),
+        "warm_read_scores": (warm_manager, lambda ctx: ctx[1].read_collection_to_df("scores", SCORE_COLUMNS)),
+        "sidebar_stats": (fresh_manager, lambda ctx: ctx[1].read_stats()),
+        "save_one_test": (warm_manager, lambda ctx: ctx[1].save_df_to_collection(pd.concat([ctx[1].read_collection_to_df("scores", SCORE_COLUMNS), new_test], ignore_index=True), "scores")),
+        "queue_one_test": (warm_manager, lambda ctx: ctx[1].queue_upsert(new_test, "scores")),
+        "queue_one_test_cold": (fresh_manager, lambda ctx: ctx[1].queue_upsert(new_test, "scores")),
+        "delete_one_test": (warm_manager, lambda ctx: ctx[1].delete_test(school_name, analysis.latest_test)),
+        "delete_school_cascade": (warm_manager, lambda ctx: ctx[1].delete_school(school_name)),
+        "purge_account": (fresh_manager, lambda ctx: ctx[1].purge_account()),
+        "analyze_school": (no_state, lambda ctx: analyze_school(school_data)),
+        "render_trend_chart": (cold_charts, render_trend),
+        "render_trend_chart_cached": (no_state, render_trend),
+        "render_radar_chart": (cold_charts, lambda ctx: create_radar_chart_html(analysis.latest_breakdown["Subject"].tolist(), analysis.latest_breakdown["Percentage"].tolist())),
+    }
+
+def flush_writes(ctx):
+    """キューに入れた書き込みの完了を待つ (レイテンシには含めず、ドキュメント数には含める)"""
+    if ctx[1] is not None: ctx[1].writes.flush()
+
+def measure(setup, run, repeat: int) -> dict:
+    """レイテンシ (中央値) と、別の実行でのピークメモリ・ドキュメント数を計測"""
+    timings = []
+    for _ in range(repeat):
+        ctx = setup()
+        start = time.perf_counter(); run(ctx); timings.append((time.perf_counter() - start) * 1000)
+        flush_writes(ctx)
+    ctx = setup()
+    tracemalloc.start()
+    try: run(ctx); _, peak = tracemalloc.get_traced_memory()
+    finally: tracemalloc.stop()
+    flush_writes(ctx)
+    client = ctx[0]
+    counts = client.counters.as_dict() if client is not None else {"round_trips": 0, "docs_read": 0, "docs_written": 0}
+    return {"latency_ms": round(statistics.median(timings), 3), "peak_memory_kb": round(peak / 1024, 1), **counts}
+
+def run_benchmarks(sizes, repeat: int) -> dict:
+    results = []
+    for n_schools, n_tests in sizes:
+        schools_df, scores_df = generate_user(n_schools, n_tests)
+        for name, (setup, run) in build_scenarios(schools_df, scores_df).items():
+            metrics = measure(setup, run, repeat)
+            results.append({"scenario": name, "size": f"{n_schools}x{n_tests}", "score_rows": len(scores_df), **metrics})
+            print(f"{name:<26} {n_schools}x{n_tests:<6} {metrics['latency_ms']:>10.2f} ms  read={metrics['docs_read']:<6} written={metrics['docs_written']:<6} trips={metrics['round_trips']:<4} peak={metrics['peak_memory_kb']:.0f} KiB")
+    return {"meta": {"python": platform.python_version(), "pandas": pd.__version__, "repeat": repeat}, "results": results}
+
+def compare(current: dict, baseline: dict, tolerance: float) -> bool:
+    """ドキュメント数・往復回数の増加、またはレイテンシが tolerance 倍を超えたら悪化とみなす"""
+    previous = {(r["scenario"], r["size"]): r for r in baseline["results"]}
+    regressed = False
+    for r in current["results"]:
+        old = previous.get((r["scenario"], r["size"]))
+        if old is None: continue
+        worse = [k for k in ("docs_read", "docs_written", "round_trips") if r[k] > old[k]]
+        if old["latency_ms"] > 0 and r["latency_ms"] > old["latency_ms"] * tolerance: worse.append("latency_ms")
+        regressed |= bool(worse)
+        print(f"{'!!' if worse else '  '} {r['scenario']:<26} {r['size']:<8} latency {old['latency_ms']:.2f} -> {r['latency_ms']:.2f} ms  read {old['docs_read']} -> {r['docs_read']}  written {old['docs_written']} -> {r['docs_written']}")
+    return not regressed
+
+def parse_sizes(text: str):
+    return [tuple(int(v) for v in size.split("x")) for size in text.split(",")]
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="カコレコのベンチマーク")
+    parser.add_argument("--sizes", default="1x10,3x50,5x200", help="志望校数x1校あたりのテスト数 (カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=5, help="レイテンシ計測の繰り返し回数")
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--compare", help="比較対象のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="レイテンシの悪化とみなす倍率")
+    args = parser.parse_args(argv)
+    # 計測ログ (バックグラウンドの書き込みのJSONログなど) が結果の表示に混ざらないよう抑える
+    # (instrumentation の import 時の設定より後に行う)
+    logging.getLogger("kakorec.metrics").setLevel(logging.WARNING)
+    current = run_benchmarks(parse_sizes(args.sizes), args.repeat)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: baseline = json.load(f)
+        return 0 if compare(current, baseline, args.tolerance) else 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""過去の成績の一括インポート・エクスポート (CSV / Parquet)
+
+ファイル全体をメモリに載せないよう、インポートはチャンクごと、エクスポートはページごとに処理する。
+行の形式は得点入力ページと同じ SCORE_COLUMNS (1行 = 1テストの1科目)。
+"""
+import io
+from typing import Iterator, List, Tuple
+import numpy as np
+import pandas as pd
+from analytics import SCORE_COLUMNS
+
+# インポート時に1回で読み込み・検証・書き込みする行数
+IMPORT_CHUNK_ROWS = 2000
+# エクスポート時に1回で読み込むドキュメント数
+EXPORT_PAGE_SIZE = 200
+# 保持・表示するエラーメッセージの上限
+IMPORT_MAX_ERRORS = 1000
+REQUIRED_COLUMNS = ["SchoolName", "TestName", "TestDate", "Subject", "Score"]
+
+def file_format(file_name: str) -> str:
+    """拡張子からファイル形式 ("csv" / "parquet") を判定"""
+    lower = file_name.lower()
+    if lower.endswith(".csv"): return "csv"
+    if lower.endswith((".parquet", ".pq")): return "parquet"
+    raise ValueError(f"対応していないファイル形式です: {file_name}")
+
+def iter_import_chunks(file, file_name: str, chunk_rows: int = IMPORT_CHUNK_ROWS) -> Iterator[Tuple[pd.DataFrame, float]]:
+    """アップロードされたファイルを chunk_rows 行ずつ読み込み、(チャンク, 進捗 0〜1) を返す
+
+    チャンクのインデックスはファイル先頭からの行位置になる。
+    """
+    if file_format(file_name) == "csv":
+        # 進捗の分母として改行数を数える (セル内の改行があると多めになるので上限を1にする)
+        total = max(sum(block.count(b"\n") for block in iter(lambda: file.read(1 << 20), b"")) - 1, 1); file.seek(0); done = 0
+        for chunk in pd.read_csv(file, chunksize=chunk_rows, dtype={"SchoolName": str, "TestName": str, "TestDate": str, "Subject": str}):
+            done += len(chunk)
+            yield chunk, min(done / total, 1.0)
+    else:
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file); total = parquet_file.metadata.num_rows; offset = 0
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            chunk = batch.to_pandas(); chunk.index = pd.RangeIndex(offset, offset + len(chunk)); offset += len(chunk)
+            yield chunk, (offset / total if total else 1.0)
+
+def validate_chunk(chunk: pd.DataFrame, schools_df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
+    """志望校の科目・満点に照らして行を検証し、(正しい行, エラーメッセージ) を返す
+
+    MaxScore 列は省略でき、省略時は志望校の満点で補う。TestDate は YYYY-MM-DD にそろえる。
+    エラーメッセージの行番号は見出しを除いたデータの行番号 (インデックス + 1、iter_import_chunks では
+    ファイル先頭からのデータの行位置) で、CSVのファイル上の行番号とは見出しの1行分ずれる。
+    """
+    missing = [col for col in REQUIRED_COLUMNS if col not in chunk.columns]
+    if missing: return pd.DataFrame(columns=SCORE_COLUMNS), [f"必須の列がありません: {', '.join(missing)}"]
+    rows = chunk.copy()
+    if "MaxScore" not in rows.columns: rows["MaxScore"] = np.nan
+    rows["Score"] = pd.to_numeric(rows["Score"], errors="coerce"); rows["MaxScore"] = pd.to_numeric(rows["MaxScore"], errors="coerce")
+    rows["TestDate"] = pd.to_datetime(rows["TestDate"], errors="coerce").dt.strftime("%Y-%m-%d")
+    # 志望校ごとの (科目, 満点) の表と突き合わせる
+    allowed = pd.DataFrame([(school, subject, float(max_score)) for school, subjects, max_scores in zip(schools_df["SchoolName"], schools_df["Subjects"], schools_df["MaxScores"]) for subject, max_score in zip(subjects, max_scores)], columns=["SchoolName", "Subject", "SchoolMaxScore"])
+    merged = rows.reset_index().merge(allowed, on=["SchoolName", "Subject"], how="left").set_index("index")
+    merged["MaxScore"] = merged["MaxScore"].fillna(merged["SchoolMaxScore"])
+    known_school = merged["SchoolName"].isin(schools_df["SchoolName"])
+    checks = [
+        (~known_school, "未登録の志望校です"),
+        (known_school & merged["SchoolMaxScore"].isna(), "志望校の受験科目にない科目です"),
+        (merged["TestName"].isna() | (merged["TestName"].astype(str).str.strip() == ""), "テスト名が空です"),
+        (merged["TestDate"].isna(), "実施日を読み取れません"),
+        (merged["MaxScore"] != merged["SchoolMaxScore"], "満点が志望校の設定と異なります"),
+        (merged["Score"].isna() | (merged["Score"] < 0) | (merged["Score"] > merged["MaxScore"]), "得点が0〜満点の範囲にありません"),
+    ]
+    invalid = pd.Series(False, index=merged.index); found = []
+    for mask, message in checks:
+        mask = mask.fillna(True) & ~invalid
+        found += [(index, message) for index in merged.index[mask]]
+        invalid |= mask
+    return merged.loc[~invalid, SCORE_COLUMNS], [f"データ{index + 1}行目: {message}" for index, message in sorted(found)]
+
+def iter_export_pages(storage_manager, page_size: int = EXPORT_PAGE_SIZE) -> Iterator[pd.DataFrame]:
+    """scoresを実施日順にページングして読み込む"""
+    cursor = None
+    while True:
+        page, cursor = storage_manager.read_page("scores", SCORE_COLUMNS, ("TestDate", "asc"), page_size, cursor=cursor)
+        if not page.empty: yield page
+        if cursor is None: return
+
+def write_export(pages: Iterator[pd.DataFrame], fmt: str, out) -> int:
+    """ページを順に out (バイナリのファイルオブジェクト) へ書き出し、書き出した行数を返す"""
+    written = 0
+    if fmt == "csv":
+        text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="", write_through=True)
+        for page in pages:
+            page.to_csv(text, header=written == 0, index=False); written += len(page)
+        if written == 0: pd.DataFrame(columns=SCORE_COLUMNS).to_csv(text, index=False)
+        text.detach()
+        return written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([("SchoolName", pa.string()), ("TestName", pa.string()), ("TestDate", pa.string()), ("Subject", pa.string()), ("Score", pa.float64()), ("MaxScore", pa.float64())])
+    with pq.ParquetWriter(out, schema) as writer:
+        for page in pages:
+            writer.write_table(pa.Table.from_pandas(page.astype({"Score": float, "MaxScore": float}), schema=schema, preserve_index=False)); written += len(page)
+    return written
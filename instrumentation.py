@@ -0,0 +1,102 @@
+"""再実行ごとの計測 (処理時間・ドキュメントの読み書き数・転送バイト数)
+
+main() が再実行の最初に start_rerun() を、最後に finish_rerun() を呼ぶ。その間に
+timed / instrumented で囲んだ処理の時間と、保存先が record_reads / record_writes で報告した読み書きを
+集計し、finish_rerun() が1行のJSONとしてログに出力する。計測中でなければ何もしない。
+"""
+import contextvars
+import functools
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("kakorec.metrics")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr); _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler); logger.propagate = False
+    # import 前に呼び出し側がレベルを設定していれば、それを優先する
+    if logger.level == logging.NOTSET: logger.setLevel(logging.INFO)
+
+class RerunMetrics:
+    """1回の再実行の計測値"""
+    def __init__(self):
+        self.started = time.perf_counter(); self.started_at = time.time()
+        self.spans = {}  # 処理名 -> {"calls": 回数, "ms": 合計時間}
+        self.docs_read = 0; self.docs_written = 0; self.bytes_read = 0; self.bytes_written = 0
+        self.labels = {}
+
+    def add_span(self, name: str, ms: float):
+        span = self.spans.setdefault(name, {"calls": 0, "ms": 0.0})
+        span["calls"] += 1; span["ms"] += ms
+
+    def to_dict(self) -> dict:
+        return {
+            "event": "rerun", "timestamp": round(self.started_at, 3), **self.labels,
+            "wall_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "docs_read": self.docs_read, "docs_written": self.docs_written, "bytes_read": self.bytes_read, "bytes_written": self.bytes_written,
+            "spans": {name: {"calls": span["calls"], "ms": round(span["ms"], 2)} for name, span in sorted(self.spans.items(), key=lambda item: -item[1]["ms"])},
+        }
+
+_current = contextvars.ContextVar("rerun_metrics", default=None)
+
+def start_rerun() -> RerunMetrics:
+    metrics = RerunMetrics(); _current.set(metrics)
+    return metrics
+
+def current_metrics():
+    return _current.get()
+
+def set_label(key: str, value):
+    """ログに含める項目 (ページ名など) を設定"""
+    metrics = _current.get()
+    if metrics is not None: metrics.labels[key] = value
+
+def finish_rerun() -> dict:
+    """計測を終了してJSONログを1行出力し、その内容を返す"""
+    metrics = _current.get()
+    if metrics is None: return {}
+    _current.set(None)
+    record = metrics.to_dict()
+    logger.info(json.dumps(record, ensure_ascii=False))
+    return record
+
+def log_event(event: str, **fields):
+    """再実行の外 (バックグラウンドの書き込みなど) の出来事をJSONログに1行出力"""
+    logger.info(json.dumps({"event": event, "timestamp": round(time.time(), 3), **fields}, ensure_ascii=False, default=str))
+
+def document_size(doc) -> int:
+    """ドキュメントの転送量の目安 (JSONにしたときのバイト数、文字列はJSON済みとみなす)"""
+    return len((doc if isinstance(doc, str) else json.dumps(doc, ensure_ascii=False, default=str)).encode("utf-8"))
+
+def record_reads(docs, count: int = None):
+    """保存先から読み込んだドキュメントを報告 (count を渡すとバイト数は数えない)"""
+    metrics = _current.get()
+    if metrics is None: return
+    if count is not None: metrics.docs_read += count; return
+    docs = list(docs); metrics.docs_read += len(docs); metrics.bytes_read += sum(map(document_size, docs))
+
+def record_writes(docs, deleted: int = 0):
+    """保存先へ書き込んだドキュメントと削除したドキュメント数を報告"""
+    metrics = _current.get()
+    if metrics is None: return
+    docs = list(docs); metrics.docs_written += len(docs) + deleted; metrics.bytes_written += sum(map(document_size, docs))
+
+@contextmanager
+def timed(name: str):
+    """with ブロックの処理時間を name として記録"""
+    start = time.perf_counter()
+    try: yield
+    finally:
+        metrics = _current.get()
+        if metrics is not None: metrics.add_span(name, (time.perf_counter() - start) * 1000)
+
+def instrumented(name: str):
+    """関数の処理時間を name として記録するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name): return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -3,14 +3,24 @@ import pandas as pd
 import os
 from typing import List
 import re
-from datetime import datetime
+import hashlib
+import tempfile
+import time
+import json
+import sqlite3
+import threading
+import operator
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter, OrderedDict
+from datetime import datetime, date, timedelta
 import numpy as np
-# --- ▼▼▼ Google連携ライブラリ（Firestore対応） ▼▼▼ ---
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from google.cloud import firestore
-# --- ▲▲▲ ここまで ▲▲▲ ---
+from analytics import SCORE_COLUMNS, analyze_school
+from bulk_io import IMPORT_MAX_ERRORS, iter_export_pages, iter_import_chunks, validate_chunk, write_export
+from write_behind import WriteBehindQueue
+from instrumentation import current_metrics, finish_rerun, instrumented, record_reads, record_writes, set_label, start_rerun, timed
+# Google連携ライブラリ (google_auth_oauthlib / google.auth / google.cloud.firestore) は
+# 読み込みに時間がかかるため、ログイン画面の表示を遅らせないよう使う関数の中で import する
 
 # ページ設定
 st.set_page_config(
@@ -47,12 +57,29 @@ ALL_SUBJECTS = [
 
 # --- ▼▼▼ ここからがGoogle/Firebase連携のためのコード ▼▼▼ ---
 
+OAUTH_SCOPES = ['https://www.googleapis.com/auth/userinfo.profile', 'https://www.googleapis.com/auth/userinfo.email', 'openid', 'https://www.googleapis.com/auth/cloud-platform']
+# ユーザー情報の取得先 (ディスカバリー文書を取得する build('oauth2', 'v2') の代わりに直接呼ぶ)
+USERINFO_URL = "https://www.googleapis.com/oauth2/v2/userinfo"
+
+@st.cache_resource(show_spinner=False)
+def load_client_config() -> dict:
+    """credentials.json を1回だけ読み込む (全セッション共通)"""
+    with open('credentials.json', encoding="utf-8") as f: return json.load(f)
+
 def get_google_auth_flow():
     """Google認証フローを初期化"""
+    from google_auth_oauthlib.flow import Flow
     if not os.path.exists('credentials.json'):
         st.error("認証ファイル `credentials.json` が見つかりません。")
         st.stop()
-    return Flow.from_client_secrets_file('credentials.json', scopes=['https://www.googleapis.com/auth/userinfo.profile', 'https://www.googleapis.com/auth/userinfo.email', 'openid', 'https://www.googleapis.com/auth/cloud-platform'], redirect_uri=st.secrets["google_oauth"]["redirect_uri"])
+    return Flow.from_client_config(load_client_config(), scopes=OAUTH_SCOPES, redirect_uri=st.secrets["google_oauth"]["redirect_uri"])
+
+def fetch_user_info(credentials) -> dict:
+    """ログインしたユーザーの id / email / name を取得"""
+    from google.auth.transport.requests import AuthorizedSession
+    response = AuthorizedSession(credentials).get(USERINFO_URL, timeout=10)
+    response.raise_for_status()
+    return response.json()
 
 def google_login_page():
     """Googleログインボタンを表示するページ"""
@@ -71,10 +98,10 @@ def process_oauth_callback():
         state = st.query_params["state"]
         if st.session_state.get('oauth_state') != state:
             st.error("不正なリクエストです。"); return
-        flow.fetch_token(code=code)
+        with timed("auth.fetch_token"): flow.fetch_token(code=code)
         credentials = flow.credentials
         st.session_state['credentials_dict'] = {'token': credentials.token, 'refresh_token': credentials.refresh_token, 'token_uri': credentials.token_uri, 'client_id': credentials.client_id, 'client_secret': credentials.client_secret, 'scopes': credentials.scopes}
-        user_info = build('oauth2', 'v2', credentials=credentials).userinfo().get().execute()
+        with timed("auth.userinfo"): user_info = fetch_user_info(credentials)
         st.session_state['user_email'] = user_info['email']
         st.session_state['user_name'] = user_info['name']
         st.session_state['user_id'] = user_info['id'] # ユーザーを一意に識別するID
@@ -84,45 +111,665 @@ def process_oauth_callback():
     except Exception as e:
         st.error(f"認証に失敗しました: {e}"); st.session_state['logged_in'] = False
 
-class FirestoreManager:
-    """ユーザーのFirestoreデータを管理するクラス"""
-    def __init__(self, creds_dict, project_id, user_id):
-        self.creds = Credentials.from_authorized_user_info(creds_dict)
-        self.db = firestore.Client(project=project_id, credentials=self.creds)
+# Firestoreの1バッチあたりの書き込み上限
+BATCH_LIMIT = 500
+# コレクションごとのドキュメントIDを決めるキー列 (scoresは1テスト1ドキュメント)
+KEY_COLUMNS = {"schools": ["SchoolName"], "scores": ["SchoolName", "TestName"]}
+# 読み込みキャッシュの有効期間 (秒) と保持するコレクション数の上限
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_ENTRIES = 8
+# サイドバー統計用のサマリードキュメント (users/{uid}/summary/stats)
+STATS_COLLECTION = "summary"
+STATS_DOC_ID = "stats"
+STATS_FIELDS = ("SchoolCount", "TestCount", "LatestTestName", "LatestTestDate", "TestNames")
+# 削除時に同時にコミットするバッチ数の上限
+DELETE_MAX_WORKERS = 4
+# アカウントデータ削除の対象コレクション
+USER_COLLECTIONS = ["schools", "scores", STATS_COLLECTION]
+# 保存形式のバージョン (2: scoresは1テスト1ドキュメント、schoolsは配列)
+SCHEMA_VERSION = 2
+# 同期的な書き込み・削除の前に、キューの書き込みが終わるのを待つ上限 (秒)
+WRITE_FLUSH_TIMEOUT_SECONDS = 10
+# 条件に使える比較演算子 (Firestoreの where と同じ表記)
+FILTER_OPERATORS = {"==": operator.eq, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+def make_doc_id(collection_name: str, record: dict) -> str:
+    """キー列から決定的なドキュメントIDを生成"""
+    key = "\x1f".join(str(record.get(col, "")) for col in KEY_COLUMNS[collection_name])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def df_to_records(df: pd.DataFrame) -> List[dict]:
+    """DataFrameをFirestoreに書き込める辞書のリストに変換 (NaNはNoneに置換)"""
+    return [{k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in rec.items()} for rec in df.to_dict("records")]
+
+def parse_list(value) -> list:
+    """配列、または旧形式のカンマ区切り文字列をリストに変換"""
+    if isinstance(value, str): return [v.strip() for v in value.split(",") if v.strip()]
+    if value is None or (isinstance(value, float) and np.isnan(value)): return []
+    return list(value)
+
+def is_legacy_document(collection_name: str, doc: dict) -> bool:
+    """旧形式 (scoresは1科目1ドキュメント、schoolsはカンマ区切り文字列) のドキュメントか判定"""
+    if collection_name == "scores": return "Results" not in doc
+    if collection_name == "schools": return isinstance(doc.get("Subjects"), str) or isinstance(doc.get("MaxScores"), str)
+    return False
+
+def encode_documents(collection_name: str, df: pd.DataFrame) -> dict:
+    """行形式のDataFrameを保存用ドキュメント {ドキュメントID: データ} に変換
+
+    scoresは (志望校, テスト) ごとに {科目: {Score, MaxScore}} のマップへまとめ、
+    schoolsは科目と満点を配列で持つ。
+    """
+    docs = {}
+    for rec in df_to_records(df):
+        doc_id = make_doc_id(collection_name, rec)
+        if collection_name == "scores":
+            doc = docs.setdefault(doc_id, {"SchoolName": rec.get("SchoolName"), "TestName": rec.get("TestName"), "TestDate": rec.get("TestDate"), "Results": {}})
+            doc["Results"][rec.get("Subject")] = {"Score": rec.get("Score"), "MaxScore": rec.get("MaxScore")}
+        elif collection_name == "schools":
+            docs[doc_id] = {"SchoolName": rec.get("SchoolName"), "Subjects": parse_list(rec.get("Subjects")), "MaxScores": [float(m) for m in parse_list(rec.get("MaxScores"))]}
+        else: docs[doc_id] = rec
+    return docs
+
+def decode_documents(collection_name: str, docs) -> List[dict]:
+    """保存用ドキュメントを行形式の辞書のリストに戻す (旧形式のドキュメントもそのまま読める)"""
+    rows = []
+    subject_order = {subject: i for i, subject in enumerate(ALL_SUBJECTS)}
+    for doc in docs:
+        if collection_name == "scores" and "Results" in doc:
+            for subject in sorted(doc["Results"], key=lambda s: subject_order.get(s, len(subject_order))):
+                result = doc["Results"][subject]
+                rows.append({"SchoolName": doc.get("SchoolName"), "TestName": doc.get("TestName"), "TestDate": doc.get("TestDate"), "Subject": subject, "Score": result.get("Score"), "MaxScore": result.get("MaxScore")})
+        elif collection_name == "schools":
+            rows.append({**doc, "Subjects": parse_list(doc.get("Subjects")), "MaxScores": [float(m) for m in parse_list(doc.get("MaxScores"))]})
+        else: rows.append(doc)
+    return rows
+
+def latest_key(doc) -> str:
+    """最新テストを決める並び順 (実施日)"""
+    return str(doc.get("TestDate") or "")
+
+def same_test(a, b) -> bool:
+    return b is not None and a.get("TestName") == b.get("TestName") and latest_key(a) == latest_key(b)
+
+def latest_test_fields(doc) -> dict:
+    return {"LatestTestName": doc.get("TestName") if doc else None, "LatestTestDate": doc.get("TestDate") if doc else None}
+
+def compute_stats(collection_name: str, docs: dict) -> dict:
+    """コレクションの全ドキュメントからサマリードキュメントの該当フィールドを計算
+
+    TestNames はテスト名ごとのドキュメント数 (キーは文字列) で、差分更新 (update_stats) で TestCount を数え直すのに使う。
+    """
+    if collection_name == "schools": return {"SchoolCount": len(docs)}
+    if collection_name == "scores":
+        names = dict(Counter(str(doc.get("TestName")) for doc in docs.values()))
+        latest = max(docs.values(), key=latest_key, default=None)
+        return {"TestNames": names, "TestCount": len(names), **latest_test_fields(latest)}
+    return {}
+
+def update_stats(collection_name: str, summary: dict, before: dict, changes: dict, load_latest):
+    """変更の前後のドキュメントからサマリーを差分で更新し、新しいサマリーを返す (更新できなければ None)
+
+    before は変更するIDのうち既存のドキュメント、changes は {ID: 変更後のデータ (削除は None)}。
+    最新テストだったドキュメントが削除・変更されたときだけ、load_latest() (実施日の新しい順の
+    (ID, データ) を少しずつ読み込むイテレーター) から変更しない最初のドキュメントを選び直す。
+    サマリーが未作成・項目不足なら None (read_stats が作り直す)。
+    """
+    if summary is None: return None
+    if collection_name == "schools" and "SchoolCount" in summary:
+        created = sum(1 for doc_id, doc in changes.items() if doc is not None and doc_id not in before)
+        removed = sum(1 for doc_id, doc in changes.items() if doc is None and doc_id in before)
+        return {**summary, "SchoolCount": summary["SchoolCount"] + created - removed}
+    if collection_name != "scores" or not all(f in summary for f in STATS_FIELDS[1:]): return None
+    names = Counter(summary["TestNames"])
+    for doc_id, doc in changes.items():
+        if doc_id in before: names[str(before[doc_id].get("TestName"))] -= 1
+        if doc is not None: names[str(doc.get("TestName"))] += 1
+    names = {name: count for name, count in names.items() if count > 0}
+    current = {"TestName": summary["LatestTestName"], "TestDate": summary["LatestTestDate"]} if summary["LatestTestName"] is not None else None
+    if current is not None and any(same_test(doc, current) and not same_test(current, changes[doc_id]) for doc_id, doc in before.items()):
+        current = next((doc for doc_id, doc in load_latest() if doc_id not in changes), None)
+    latest = max([doc for doc in changes.values() if doc is not None] + ([current] if current else []), key=latest_key, default=None)
+    return {**summary, "TestNames": names, "TestCount": len(names), **latest_test_fields(latest)}
+
+# 最新テストを選び直すときに1回で読み込むドキュメント数
+LATEST_PAGE_SIZE = 10
+
+def iter_latest(fetch_page):
+    """fetch_page(カーソル) で実施日の新しい順に LATEST_PAGE_SIZE 件ずつ読み込み、(ID, データ) を順に返す"""
+    cursor = None
+    while True:
+        page = fetch_page(cursor)
+        yield from page.items()
+        if len(page) < LATEST_PAGE_SIZE: return
+        last_id = next(reversed(page)); cursor = (page[last_id]["TestDate"], last_id)
+
+def apply_query(records: dict, filters=(), order_by=None, limit=None, start_after=None) -> dict:
+    """メモリ上のドキュメントに条件・並び順・カーソルを適用 (キャッシュ済みのスナップショット用)
+
+    filters は (フィールド, 演算子, 値) のタプル、order_by は (フィールド, "asc" | "desc")、
+    start_after は直前のページ末尾の (並び順フィールドの値, ドキュメントID)。
+    """
+    items = [(doc_id, doc) for doc_id, doc in records.items() if all(doc.get(field) is not None and FILTER_OPERATORS[op](doc.get(field), value) for field, op, value in filters)]
+    if order_by is not None:
+        field, direction = order_by; descending = direction == "desc"
+        items = sorted(((doc_id, doc) for doc_id, doc in items if doc.get(field) is not None), key=lambda item: (item[1][field], item[0]), reverse=descending)
+        if start_after is not None:
+            items = [(doc_id, doc) for doc_id, doc in items if ((doc[field], doc_id) < tuple(start_after) if descending else (doc[field], doc_id) > tuple(start_after))]
+    return dict(items[:limit] if limit is not None else items)
+
+class StorageManager:
+    """保存先に依存しない読み書き (差分保存・キャッシュ) を担う基底クラス
+
+    サブクラスは _query_records と _commit_changes などを実装する。_commit_changes と
+    _delete_matching は、変更するドキュメントとサマリーをトランザクションの中で読み込み、
+    update_stats で差分更新したサマリーを変更と同じ書き込み単位で書き込む
+    (別のタブ・セッションの書き込みと競合しても件数がずれない)。
+    """
+    def __init__(self, user_id):
         self.user_id = user_id
+        # (ユーザーID, コレクション名[, 条件]) -> (読み込み時刻, {ドキュメントID: データ})
+        # インスタンスはセッション状態に保持されるため、再実行をまたいで再利用される
+        self._cache = OrderedDict()
+        # 保存ボタンの書き込みを受け持つキュー (ワーカーは _write_behind_commit だけを呼ぶ)
+        self.writes = WriteBehindQueue(self._write_behind_commit)
 
-    def _delete_collection(self, coll_ref):
-        docs = coll_ref.limit(100).stream()
-        deleted = 0
-        for doc in docs:
-            doc.reference.delete()
-            deleted += 1
-        if deleted >= 100: self._delete_collection(coll_ref)
+    def _query_records(self, collection_name: str, filters=(), order_by=None, limit=None, start_after=None) -> dict:
+        """条件・並び順・カーソルを保存先で評価し、{ドキュメントID: データ} を並び順どおりに取得 (引数は apply_query と同じ)"""
+        raise NotImplementedError
 
-    def read_collection_to_df(self, collection_name: str, columns: list) -> pd.DataFrame:
-        try:
-            coll_ref = self.db.collection('users', self.user_id, collection_name)
-            docs = coll_ref.stream()
-            data = [doc.to_dict() for doc in docs]
-            df = pd.DataFrame(data)
-            for col in columns:
-                if col not in df.columns: df[col] = None
-            return df[columns] if not df.empty else pd.DataFrame(columns=columns)
+    def _load_records(self, collection_name: str) -> dict:
+        """保存済みドキュメントを {ドキュメントID: データ} で全件取得"""
+        return self._query_records(collection_name)
+
+    def _commit_changes(self, collection_name: str, upserts: dict, deletes: List[str]) -> dict:
+        """変更分 (上書きと削除) とサマリーの差分更新を書き込み、更新後のサマリーを返す (更新しなかったら {})"""
+        raise NotImplementedError
+
+    def _write_summary(self, fields: dict) -> dict:
+        """サマリーの項目を置き換えて (ほかの項目は残す)、更新後のサマリーを返す"""
+        raise NotImplementedError
+
+    def _fetch_documents(self, collection_name: str, doc_ids: List[str]) -> dict:
+        """指定したIDのドキュメントだけを取得 (存在しないIDは含めない)"""
+        raise NotImplementedError
+
+    def _delete_matching(self, collection_name: str, filters=(), track_stats: bool = True) -> int:
+        """条件に一致するドキュメントを一括削除し、削除した件数を返す (track_stats なら同じ書き込み単位でサマリーも更新)"""
+        raise NotImplementedError
+
+    def _cache_key(self, collection_name: str, filters=()) -> tuple:
+        return (self.user_id, collection_name, tuple(tuple(f) for f in filters)) if filters else (self.user_id, collection_name)
+
+    def _cached(self, key: tuple):
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < CACHE_TTL_SECONDS:
+            self._cache.move_to_end(key)
+            return entry[1]
+        return None
+
+    def _get_records(self, collection_name: str, filters=()) -> dict:
+        """キャッシュを優先してドキュメントを取得
+
+        全件のスナップショットがあればメモリ上で絞り込み、なければ条件を保存先に渡して
+        該当分だけを読み込む。
+        """
+        full = self._cached(self._cache_key(collection_name))
+        if full is not None: return apply_query(full, filters) if filters else full
+        if filters:
+            records = self._cached(self._cache_key(collection_name, filters))
+            if records is not None: return records
+        records = self._query_records(collection_name, filters)
+        # まだ保存先に反映されていない変更を重ねてからキャッシュする
+        overlay = self.writes.overlay(collection_name)
+        if overlay: records.update(apply_query(overlay, filters))
+        self._store_cache(collection_name, records, filters)
+        return records
+
+    def _store_cache(self, collection_name: str, records: dict, filters=()):
+        key = self._cache_key(collection_name, filters)
+        self._cache[key] = (time.monotonic(), records)
+        self._cache.move_to_end(key)
+        while len(self._cache) > CACHE_MAX_ENTRIES: self._cache.popitem(last=False)
+
+    def invalidate(self, collection_name: str = None):
+        """キャッシュを破棄 (コレクション名を省略すると全て、指定すると条件付きの分も含めて破棄)"""
+        if collection_name is None: self._cache.clear()
+        else:
+            for key in [k for k in self._cache if k[1] == collection_name]: del self._cache[key]
+
+    def _records_to_df(self, collection_name: str, records: dict, columns: list) -> pd.DataFrame:
+        df = pd.DataFrame(decode_documents(collection_name, records.values()))
+        for col in columns:
+            if col not in df.columns: df[col] = None
+        return df[columns] if not df.empty else pd.DataFrame(columns=columns)
+
+    @instrumented("storage.read_collection_to_df")
+    def read_collection_to_df(self, collection_name: str, columns: list, filters=()) -> pd.DataFrame:
+        """filters ((フィールド, 演算子, 値) のリスト) に一致するドキュメントだけを読み込む"""
+        try: return self._records_to_df(collection_name, self._get_records(collection_name, filters), columns)
         except Exception: return pd.DataFrame(columns=columns)
 
+    @instrumented("storage.read_page")
+    def read_page(self, collection_name: str, columns: list, order_by, page_size: int, filters=(), cursor=None):
+        """order_by の順に page_size 件のドキュメントを読み込み、(DataFrame, 次ページのカーソル) を返す
+
+        キャッシュ済みのスナップショットがあればメモリ上でページングし、なければ保存先で
+        カーソル付きのクエリを実行する。最後のページではカーソルは None になる。
+        """
+        snapshot = self._cached(self._cache_key(collection_name))
+        if snapshot is None: snapshot = self._cached(self._cache_key(collection_name, filters))
+        elif filters: snapshot = apply_query(snapshot, filters)
+        if snapshot is not None: records = apply_query(snapshot, (), order_by, page_size, cursor)
+        else:
+            records = self._query_records(collection_name, filters, order_by, page_size, cursor)
+            overlay = self.writes.overlay(collection_name)
+            if overlay: records = apply_query({**records, **apply_query(overlay, filters)}, (), order_by, page_size, cursor)
+        next_cursor = None
+        if len(records) == page_size:
+            last_id = next(reversed(records)); next_cursor = (records[last_id][order_by[0]], last_id)
+        return self._records_to_df(collection_name, records, columns), next_cursor
+
+    @instrumented("storage.save_df_to_collection")
     def save_df_to_collection(self, df: pd.DataFrame, collection_name: str) -> bool:
+        """保存済みの状態との差分 (変更行の上書きと削除行の削除) だけを書き込む"""
         try:
-            coll_ref = self.db.collection('users', self.user_id, collection_name)
-            self._delete_collection(coll_ref)
-            batch = self.db.batch()
-            for _, row in df.iterrows():
-                doc_ref = coll_ref.document()
-                batch.set(doc_ref, row.to_dict())
-            batch.commit()
+            self._flush_writes()
+            stored = self._get_records(collection_name)
+            desired = encode_documents(collection_name, df)
+            upserts = {doc_id: rec for doc_id, rec in desired.items() if stored.get(doc_id) != rec}
+            deletes = [doc_id for doc_id in stored if doc_id not in desired]
+            if upserts or deletes: self._store_summary(self._commit_changes(collection_name, upserts, deletes))
+            self.invalidate(collection_name); self._store_cache(collection_name, desired)
             return True
         except Exception as e:
+            self.invalidate(collection_name)
             st.error(f"データベース保存エラー: {e}"); return False
 
+    @instrumented("storage.queue_upsert")
+    def queue_upsert(self, df: pd.DataFrame, collection_name: str) -> int:
+        """DataFrameの行をすぐにキャッシュへ反映し、書き込みはキューに任せる (保存先の応答を待たない)
+
+        DataFrameの行に対応するドキュメントを丸ごと上書きし、ない行は削除しない。保存先には一切
+        アクセスしない: サマリーは全件のスナップショットとサマリーがどちらもキャッシュにあるときだけ
+        差分ですぐに反映し、なければキャッシュから外す (保存先のサマリーはワーカーの書き込みと同じ
+        トランザクションで更新される)。同期の状態は self.writes.status() で確認する。戻り値はキューに入れたドキュメント数。
+        """
+        docs = encode_documents(collection_name, df)
+        full = self._cached(self._cache_key(collection_name))
+        summary = (self._cached(self._cache_key(STATS_COLLECTION)) or {}).get(STATS_DOC_ID)
+        if full is not None and summary is not None:
+            summary = update_stats(collection_name, summary, {doc_id: full[doc_id] for doc_id in docs if doc_id in full}, docs, lambda: iter(apply_query(full, order_by=("TestDate", "desc")).items()))
+        else: summary = None
+        if summary is not None: self._store_summary(summary)
+        else: self.invalidate(STATS_COLLECTION)
+        for key in [k for k in self._cache if k[1] == collection_name and len(k) == 3]: del self._cache[key]
+        if full is not None: full.update(docs)
+        self.writes.put(collection_name, docs)
+        return len(docs)
+
+    def _flush_writes(self):
+        """キューの書き込みが終わるのを待つ (時間切れなら TimeoutError を送出して呼び出し元の処理を中止させる)"""
+        if not self.writes.flush(WRITE_FLUSH_TIMEOUT_SECONDS): raise TimeoutError("同期中の書き込みが終わらないため中止しました。しばらくしてからもう一度お試しください")
+
+    def _write_behind_commit(self, collection_name: str, upserts: dict):
+        """キューのワーカースレッドから呼ばれる書き込み (st.* とキャッシュには触れない)"""
+        self._commit_changes(collection_name, upserts, [])
+
+    def discard_queued_writes(self):
+        """未同期 (同期待ち・失敗) の変更を取り消し、キャッシュを保存先の状態に戻す"""
+        for collection_name in self.writes.discard(): self.invalidate(collection_name)
+        self.invalidate(STATS_COLLECTION)
+
+    def _drop_queued(self, collection_name: str, filters=()):
+        """削除するドキュメントへの未同期の変更を取り消し、書き込み中の分が終わるのを待つ"""
+        self.writes.discard(collection_name, list(apply_query(self.writes.overlay(collection_name), filters)))
+        self._flush_writes()
+
+    def _forget_deleted(self, collection_name: str, filters=()):
+        """削除後にキャッシュを合わせる (全件のスナップショットからは該当分だけを取り除く)"""
+        full = self._cached(self._cache_key(collection_name))
+        self.invalidate(collection_name)
+        if full is not None and filters:
+            removed = apply_query(full, filters)
+            self._store_cache(collection_name, {doc_id: doc for doc_id, doc in full.items() if doc_id not in removed})
+
+    @instrumented("storage.delete_school")
+    def delete_school(self, school_name: str):
+        """志望校とその志望校のテスト結果をまとめて削除し、削除したドキュメント数を返す (失敗時は None)"""
+        try:
+            filters = [("SchoolName", "==", school_name)]
+            self._drop_queued("scores", filters); self._drop_queued("schools", filters)
+            deleted = self._delete_matching("scores", filters) + self._delete_matching("schools", filters)
+            self._forget_deleted("scores", filters); self._forget_deleted("schools", filters); self.invalidate(STATS_COLLECTION)
+            return deleted
+        except Exception as e:
+            self.invalidate(); st.error(f"データベース削除エラー: {e}"); return None
+
+    @instrumented("storage.delete_test")
+    def delete_test(self, school_name: str, test_name: str):
+        """1回分のテスト結果を削除し、削除したドキュメント数を返す (失敗時は None)"""
+        try:
+            filters = [("SchoolName", "==", school_name), ("TestName", "==", test_name)]
+            self._drop_queued("scores", filters)
+            deleted = self._delete_matching("scores", filters)
+            self._forget_deleted("scores", filters); self.invalidate(STATS_COLLECTION)
+            return deleted
+        except Exception as e:
+            self.invalidate(); st.error(f"データベース削除エラー: {e}"); return None
+
+    @instrumented("storage.purge_account")
+    def purge_account(self):
+        """このユーザーの全データ (志望校・テスト結果・サマリー) を削除し、削除したドキュメント数を返す (失敗時は None)"""
+        try:
+            self.writes.discard(); self._flush_writes()
+            # サマリーも削除するため、削除中は更新しない
+            return sum(self._delete_matching(collection_name, track_stats=False) for collection_name in USER_COLLECTIONS)
+        except Exception as e: st.error(f"データベース削除エラー: {e}"); return None
+        finally: self.invalidate()
+
+    @instrumented("storage.upsert_df")
+    def upsert_df(self, df: pd.DataFrame, collection_name: str) -> int:
+        """DataFrameの行を既存のドキュメントへマージして書き込み、書き込んだドキュメント数を返す
+
+        save_df_to_collection と違い、DataFrameにない行は削除しない (一括インポート用)。
+        既存のドキュメントは該当IDの分だけを読み込む。失敗時は例外をそのまま送出する。
+        """
+        self._flush_writes()
+        desired = encode_documents(collection_name, df)
+        full = self._cached(self._cache_key(collection_name))
+        existing = {doc_id: full[doc_id] for doc_id in desired if doc_id in full} if full is not None else self._fetch_documents(collection_name, list(desired))
+        if collection_name == "scores":
+            # 同じテストの既存の科目は残し、ファイルにある科目だけを上書きする
+            desired = {doc_id: ({**doc, "Results": {**existing[doc_id]["Results"], **doc["Results"]}} if "Results" in existing.get(doc_id, {}) else doc) for doc_id, doc in desired.items()}
+        upserts = {doc_id: doc for doc_id, doc in desired.items() if existing.get(doc_id) != doc}
+        if upserts: self._store_summary(self._commit_changes(collection_name, upserts, []))
+        self.invalidate(collection_name)
+        if full is not None: full.update(upserts); self._store_cache(collection_name, full)
+        return len(upserts)
+
+    def _store_summary(self, summary: dict):
+        if summary: self._store_cache(STATS_COLLECTION, {STATS_DOC_ID: summary})
+
+    @instrumented("storage.read_stats")
+    def read_stats(self) -> dict:
+        """サマリードキュメントを1件だけ読む (未作成・項目不足なら生データから作成)"""
+        stats = self._get_records(STATS_COLLECTION).get(STATS_DOC_ID)
+        if stats is not None and all(f in stats for f in STATS_FIELDS): return stats
+        try: return self.rebuild_stats()
+        except TimeoutError as e: st.warning(f"統計を計算できませんでした: {e}"); return stats or {}
+
+    @instrumented("storage.rebuild_stats")
+    def rebuild_stats(self) -> dict:
+        """scores・schoolsの生データからサマリードキュメントを再計算して保存 (同期が終わらなければ TimeoutError)"""
+        self._flush_writes()
+        stats = {**compute_stats("schools", self._load_records("schools")), **compute_stats("scores", self._load_records("scores"))}
+        summary = self._write_summary(stats); self._store_summary(summary)
+        return summary
+
+    @instrumented("storage.migrate_legacy_schema")
+    def migrate_legacy_schema(self) -> int:
+        """旧形式のドキュメントを新形式へ一括変換し、変換したドキュメント数を返す
+
+        変換済みかどうかはサマリードキュメントの SchemaVersion で判定するため、
+        2回目以降はコレクション全体を読み込まない。
+        """
+        if (self._get_records(STATS_COLLECTION).get(STATS_DOC_ID) or {}).get("SchemaVersion", 0) >= SCHEMA_VERSION: return 0
+        migrated = 0
+        for collection_name, columns in [("schools", ["SchoolName", "Subjects", "MaxScores"]), ("scores", SCORE_COLUMNS)]:
+            legacy = [doc for doc in self._get_records(collection_name).values() if is_legacy_document(collection_name, doc)]
+            if not legacy: continue
+            if not self.save_df_to_collection(self.read_collection_to_df(collection_name, columns), collection_name): return migrated
+            migrated += len(legacy)
+        self._store_summary(self._write_summary({"SchemaVersion": SCHEMA_VERSION}))
+        return migrated
+
+class FirestoreManager(StorageManager):
+    """ユーザーのFirestoreデータを管理するクラス"""
+    def __init__(self, creds_dict, project_id, user_id, db=None):
+        super().__init__(user_id)
+        # db を渡すと既存のクライアント (ベンチマーク用の疑似Firestoreなど) を使う
+        # クライアントはこのインスタンス (= セッション) だけが持ち、ログアウトで認証情報ごと破棄される
+        self.db = db if db is not None else self._create_client(creds_dict, project_id)
+
+    @staticmethod
+    def _create_client(creds_dict, project_id):
+        from google.cloud import firestore
+        from google.oauth2.credentials import Credentials
+        return firestore.Client(project=project_id, credentials=Credentials.from_authorized_user_info(creds_dict))
+
+    def _collection(self, collection_name: str):
+        return self.db.collection('users', self.user_id, collection_name)
+
+    def _summary_ref(self):
+        return self._collection(STATS_COLLECTION).document(STATS_DOC_ID)
+
+    def _query(self, collection_name: str, filters=(), order_by=None, limit=None, start_after=None):
+        """条件と並び順を where / order_by に変換したクエリ
+
+        志望校での絞り込みと実施日の範囲・並び順を組み合わせるには複合インデックスが必要
+        (firestore.indexes.json を参照)。
+        """
+        from google.cloud import firestore
+        query = self._collection(collection_name)
+        for field, op, value in filters: query = query.where(filter=firestore.FieldFilter(field, op, value))
+        if order_by is not None:
+            field, direction = order_by
+            firestore_direction = firestore.Query.DESCENDING if direction == "desc" else firestore.Query.ASCENDING
+            query = query.order_by(field, direction=firestore_direction).order_by("__name__", direction=firestore_direction)
+            if start_after is not None: query = query.start_after({field: start_after[0], "__name__": start_after[1]})
+        if limit is not None: query = query.limit(limit)
+        return query
+
+    def _query_records(self, collection_name: str, filters=(), order_by=None, limit=None, start_after=None) -> dict:
+        """条件と並び順をFirestore側で評価して絞り込む"""
+        records = {doc.id: doc.to_dict() for doc in self._query(collection_name, filters, order_by, limit, start_after).stream()}
+        record_reads(records.values())
+        return records
+
+    def _fetch_documents(self, collection_name: str, doc_ids: List[str]) -> dict:
+        coll_ref = self._collection(collection_name)
+        found = {snap.id: snap.to_dict() for snap in self.db.get_all([coll_ref.document(doc_id) for doc_id in doc_ids]) if snap.exists}
+        # 存在しないIDも1件の読み込みとして課金される
+        record_reads(found.values()); record_reads((), count=len(doc_ids) - len(found))
+        return found
+
+    def _run_transaction(self, func):
+        """func(transaction) をトランザクションで実行 (競合したらFirestoreが読み込みからやり直す)"""
+        from google.cloud import firestore
+        return firestore.transactional(func)(self.db.transaction())
+
+    def _write_in_transaction(self, transaction, collection_name: str, summary: dict, before: dict, changes: dict) -> dict:
+        """読み込み済みのサマリーと変更前のドキュメントからサマリーを差分で更新し、changes と一緒にトランザクションへ書き込む"""
+        coll_ref = self._collection(collection_name)
+        def fetch_page(cursor):
+            page = {snap.id: snap.to_dict() for snap in transaction.get(self._query(collection_name, order_by=("TestDate", "desc"), limit=LATEST_PAGE_SIZE, start_after=cursor))}
+            record_reads(page.values())
+            return page
+        summary = update_stats(collection_name, summary, before, changes, lambda: iter_latest(fetch_page))
+        for doc_id, doc in changes.items():
+            if doc is None: transaction.delete(coll_ref.document(doc_id))
+            else: transaction.set(coll_ref.document(doc_id), doc)
+        if summary is not None: transaction.set(self._summary_ref(), summary)
+        return summary
+
+    def _commit_transaction(self, collection_name: str, changes: dict) -> dict:
+        """changes ({ID: データ、削除は None}) とサマリーの差分更新を1つのトランザクションで書き込む"""
+        coll_ref = self._collection(collection_name)
+        def run(transaction):
+            # 変更するドキュメントとサマリーを1回の往復で読み込む (ドキュメントIDが "stats" になることはない)
+            snapshots = list(transaction.get_all([self._summary_ref()] + [coll_ref.document(doc_id) for doc_id in changes]))
+            found = {snap.id: snap.to_dict() for snap in snapshots if snap.exists}
+            record_reads(found.values()); record_reads((), count=len(snapshots) - len(found))
+            summary = found.pop(STATS_DOC_ID, None)
+            return self._write_in_transaction(transaction, collection_name, summary, found, changes)
+        summary = self._run_transaction(run)
+        record_writes([doc for doc in changes.values() if doc is not None] + ([summary] if summary else []), deleted=sum(doc is None for doc in changes.values()))
+        return summary or {}
+
+    def _delete_chunk(self, query, collection_name: str) -> int:
+        """条件に一致するドキュメントをバッチ上限 (サマリーの1件分を除く) まで、サマリーの更新と同じトランザクションで削除"""
+        # サマリーの差分に必要なフィールドだけを、トランザクションの中で1回だけ読み込む
+        fields = ["TestName", "TestDate"] if collection_name == "scores" else []
+        def run(transaction):
+            snapshot = next(iter(transaction.get_all([self._summary_ref()])))
+            before = {snap.id: snap.to_dict() for snap in transaction.get(query.select(fields).limit(BATCH_LIMIT - 1))}
+            record_reads((), count=1); record_reads(before.values())
+            summary = self._write_in_transaction(transaction, collection_name, snapshot.to_dict() if snapshot.exists else None, before, dict.fromkeys(before))
+            return len(before), summary
+        deleted, summary = self._run_transaction(run)
+        record_writes([summary] if summary else [], deleted=deleted)
+        return deleted
+
+    def _delete_matching(self, collection_name: str, filters=(), track_stats: bool = True) -> int:
+        """条件に一致するドキュメントを削除する
+
+        track_stats ならサマリーと同じトランザクションでバッチ上限ごとに削除する (トランザクションごとに
+        サマリーを読み書きするため、チャンクは順に処理する)。そうでなければIDだけを読み込み、
+        最大 DELETE_MAX_WORKERS 個のバッチを並行してコミットする。
+        """
+        query = self._query(collection_name, filters)
+        if track_stats:
+            deleted = 0
+            while True:
+                count = self._delete_chunk(query, collection_name); deleted += count
+                if count < BATCH_LIMIT - 1: return deleted
+        deleted = 0; pending = set(); batch = self.db.batch(); batch_size = 0
+        with ThreadPoolExecutor(max_workers=DELETE_MAX_WORKERS) as executor:
+            def submit(batch):
+                if len(pending) >= DELETE_MAX_WORKERS:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done: pending.discard(future); future.result()
+                pending.add(executor.submit(batch.commit))
+            for snapshot in query.select([]).stream():
+                batch.delete(snapshot.reference); batch_size += 1; deleted += 1
+                if batch_size == BATCH_LIMIT: submit(batch); batch = self.db.batch(); batch_size = 0
+            if batch_size: submit(batch)
+            for future in pending: future.result()
+        record_reads((), count=deleted); record_writes((), deleted=deleted)
+        return deleted
+
+    def _commit_changes(self, collection_name: str, upserts: dict, deletes: List[str]) -> dict:
+        """変更分を書き込み上限ごと (サマリーの1件分を除く) に分割し、それぞれをサマリーと同じトランザクションで書き込む"""
+        changes = list(upserts.items()) + [(doc_id, None) for doc_id in deletes]; summary = {}
+        for start in range(0, len(changes), BATCH_LIMIT - 1): summary = self._commit_transaction(collection_name, dict(changes[start:start + BATCH_LIMIT - 1])) or summary
+        return summary
+
+    def _write_summary(self, fields: dict) -> dict:
+        summary_ref = self._summary_ref()
+        def run(transaction):
+            snapshot = next(iter(transaction.get_all([summary_ref])))
+            # set(merge=True) では TestNames のようなマップが入れ子でマージされ、消えたキーが残るため丸ごと書き直す
+            summary = {**(snapshot.to_dict() or {}), **fields}; transaction.set(summary_ref, summary)
+            return summary
+        summary = self._run_transaction(run)
+        record_reads((), count=1); record_writes([summary])
+        return summary
+
+class SQLiteManager(StorageManager):
+    """ユーザーのデータをローカルのSQLiteファイルで管理するクラス (ローカル実行・負荷試験向け)"""
+    def __init__(self, db_path, user_id):
+        super().__init__(user_id)
+        # Streamlitは再実行ごとに別スレッドで動くことがあるため、スレッドをまたいで共有しロックで保護する
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS documents (user_id TEXT NOT NULL, collection TEXT NOT NULL, doc_id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (user_id, collection, doc_id)) WITHOUT ROWID")
+            # 志望校での絞り込みと実施日順の読み込み用
+            self.conn.execute("CREATE INDEX IF NOT EXISTS documents_school_date ON documents (user_id, collection, json_extract(data, '$.SchoolName'), json_extract(data, '$.TestDate'))")
+
+    def _select_sql(self, collection_name: str, filters=(), order_by=None, limit=None, start_after=None):
+        """条件と並び順をSELECT文に変換 (フィールド名はコード内の定数のみを想定)"""
+        sql, params = self._where_sql(collection_name, filters); sql = "SELECT doc_id, data FROM documents WHERE " + sql
+        if order_by is not None:
+            field, direction = order_by
+            if not re.fullmatch(r"\w+", field): raise ValueError(f"不正な並び順です: {field}")
+            column = f"json_extract(data, '$.{field}')"; cmp, sort = ("<", "DESC") if direction == "desc" else (">", "ASC")
+            sql += f" AND {column} IS NOT NULL"
+            if start_after is not None: sql += f" AND ({column} {cmp} ? OR ({column} = ? AND doc_id {cmp} ?))"; params += [start_after[0], start_after[0], start_after[1]]
+            sql += f" ORDER BY {column} {sort}, doc_id {sort}"
+        if limit is not None: sql += " LIMIT ?"; params.append(limit)
+        return sql, params
+
+    def _select(self, sql: str, params) -> dict:
+        """SELECT文を実行して {ドキュメントID: データ} を返す (呼び出し側でロックを持つ)"""
+        rows = self.conn.execute(sql, params).fetchall()
+        record_reads(data for _, data in rows)
+        return {doc_id: json.loads(data) for doc_id, data in rows}
+
+    def _select_ids(self, collection_name: str, doc_ids: List[str]) -> dict:
+        found = {}
+        for start in range(0, len(doc_ids), BATCH_LIMIT):
+            chunk = doc_ids[start:start + BATCH_LIMIT]
+            found.update(self._select(f"SELECT doc_id, data FROM documents WHERE user_id = ? AND collection = ? AND doc_id IN ({','.join('?' * len(chunk))})", [self.user_id, collection_name, *chunk]))
+        return found
+
+    def _query_records(self, collection_name: str, filters=(), order_by=None, limit=None, start_after=None) -> dict:
+        """条件と並び順をSQLで評価して絞り込む"""
+        with self.lock:
+            return self._select(*self._select_sql(collection_name, filters, order_by, limit, start_after))
+
+    def _where_sql(self, collection_name: str, filters=()):
+        """ユーザー・コレクション・条件のWHERE句とパラメーター"""
+        sql = "user_id = ? AND collection = ?"; params = [self.user_id, collection_name]
+        for field, op, value in filters:
+            if op not in FILTER_OPERATORS or not re.fullmatch(r"\w+", field): raise ValueError(f"不正な条件です: {field} {op}")
+            sql += f" AND json_extract(data, '$.{field}') {'=' if op == '==' else op} ?"; params.append(value)
+        return sql, params
+
+    def _delete_matching(self, collection_name: str, filters=(), track_stats: bool = True) -> int:
+        """1トランザクションで削除 (track_stats なら削除するドキュメントを読み込んでサマリーも更新)"""
+        sql, params = self._where_sql(collection_name, filters)
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if track_stats:
+                doc_ids = [row[0] for row in self.conn.execute("SELECT doc_id FROM documents WHERE " + sql, params).fetchall()]
+                self._apply_changes(collection_name, {doc_id: None for doc_id in doc_ids})
+                return len(doc_ids)
+            deleted = self.conn.execute("DELETE FROM documents WHERE " + sql, params).rowcount
+        record_writes((), deleted=deleted)
+        return deleted
+
+    def _fetch_documents(self, collection_name: str, doc_ids: List[str]) -> dict:
+        with self.lock:
+            return self._select_ids(collection_name, doc_ids)
+
+    def _put_summary(self, summary: dict):
+        self.conn.execute("INSERT OR REPLACE INTO documents (user_id, collection, doc_id, data) VALUES (?, ?, ?, ?)", (self.user_id, STATS_COLLECTION, STATS_DOC_ID, json.dumps(summary, ensure_ascii=False)))
+
+    def _apply_changes(self, collection_name: str, changes: dict) -> dict:
+        """changes ({ID: データ、削除は None}) を書き込んでサマリーを差分更新 (呼び出し側でロックとトランザクションを持つ)"""
+        before = self._select_ids(collection_name, list(changes))
+        summary = self._select_ids(STATS_COLLECTION, [STATS_DOC_ID]).get(STATS_DOC_ID)
+        summary = update_stats(collection_name, summary, before, changes, lambda: iter_latest(lambda cursor: self._select(*self._select_sql(collection_name, order_by=("TestDate", "desc"), limit=LATEST_PAGE_SIZE, start_after=cursor))))
+        rows = [(self.user_id, collection_name, doc_id, json.dumps(doc, ensure_ascii=False)) for doc_id, doc in changes.items() if doc is not None]
+        deletes = [(self.user_id, collection_name, doc_id) for doc_id, doc in changes.items() if doc is None]
+        self.conn.executemany("INSERT OR REPLACE INTO documents (user_id, collection, doc_id, data) VALUES (?, ?, ?, ?)", rows)
+        self.conn.executemany("DELETE FROM documents WHERE user_id = ? AND collection = ? AND doc_id = ?", deletes)
+        if summary is not None: self._put_summary(summary)
+        record_writes([row[3] for row in rows] + ([summary] if summary else []), deleted=len(deletes))
+        return summary or {}
+
+    def _commit_changes(self, collection_name: str, upserts: dict, deletes: List[str]) -> dict:
+        """変更分とサマリーの差分更新を1トランザクションで書き込む (BEGIN IMMEDIATE で読み込みから書き込みまでを排他にする)"""
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self._apply_changes(collection_name, {**upserts, **{doc_id: None for doc_id in deletes}})
+
+    def _write_summary(self, fields: dict) -> dict:
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            summary = {**(self._select_ids(STATS_COLLECTION, [STATS_DOC_ID]).get(STATS_DOC_ID) or {}), **fields}; self._put_summary(summary)
+        record_writes([summary])
+        return summary
+
+def create_storage_manager(creds_dict, user_id) -> StorageManager:
+    """secretsの [storage] backend に応じて保存先を選択 (既定はFirestore)"""
+    storage_conf = st.secrets.get("storage", {})
+    if storage_conf.get("backend", "firestore") == "sqlite":
+        return SQLiteManager(storage_conf.get("sqlite_path", "kakomon.db"), user_id)
+    return FirestoreManager(creds_dict, st.secrets["gcp"]["project_id"], user_id)
+
 # --- ▲▲▲ ここまでがGoogle/Firebase連携のためのコード ▲▲▲ ---
 
 def init_session_state():
@@ -132,7 +779,7 @@ def init_session_state():
     if 'user_name' not in st.session_state: st.session_state.user_name = ""
 
 # (ここから下のUIヘルパー関数、ページ関数、main関数は元のコードと同一のロジックを維持し、
-# データ読み書きの部分だけをFirestoreManagerを使うように変更しています)
+# データ読み書きの部分だけをStorageManagerを使うように変更しています)
 
 def create_progress_bar(value: float, max_value: float, label: str = "") -> str:
     # (元のコードから変更なし)
@@ -145,49 +792,116 @@ def create_progress_bar(value: float, max_value: float, label: str = "") -> str:
         return f"""<div class="progress-bar"><div class="progress-bar-fill" style="width: {percentage}%; background-color: {color};">{label} {percentage:.1f}%</div></div>"""
     except Exception: return f"<div>{label}: エラー</div>"
 
+# 成績推移グラフに描画する最大の本数 (これを超えると間引く)
+TREND_MAX_POINTS = 60
+# 描画済みHTMLを保持する件数
+CHART_CACHE_ENTRIES = 64
+
+_chart_cache = OrderedDict()
+_chart_cache_lock = threading.Lock()
+
+def memoize_html(error_label: str):
+    """入力の系列のハッシュをキーに、描画済みのHTMLを再利用するデコレーター (全セッション共通・件数上限付き)
+
+    描画に失敗したときは error_label 付きのメッセージを返し、キャッシュしない (次回はもう一度描画する)。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__name__, hashlib.sha1(repr((args, sorted(kwargs.items()))).encode("utf-8")).hexdigest())
+            with _chart_cache_lock:
+                if key in _chart_cache:
+                    _chart_cache.move_to_end(key); return _chart_cache[key]
+            try: html = func(*args, **kwargs)
+            except Exception as e: return f"<div>{error_label}: {e}</div>"
+            with _chart_cache_lock:
+                _chart_cache[key] = html
+                while len(_chart_cache) > CHART_CACHE_ENTRIES: _chart_cache.popitem(last=False)
+            return html
+        return wrapper
+    return decorator
+
+def downsample_lttb(values: List[float], max_points: int) -> List[int]:
+    """LTTB (Largest-Triangle-Three-Buckets) で間引いたときに残す位置を昇順で返す
+
+    先頭・末尾に加えて最高値・最低値も必ず残す (そのため最大で max_points + 2 点になる)。
+    max_points は3未満なら3とみなす (先頭・末尾と1バケット分)。
+    """
+    n = len(values); max_points = max(max_points, 3)
+    if n <= max_points: return list(range(n))
+    y = np.nan_to_num(np.asarray(values, dtype=float)); x = np.arange(n, dtype=float)
+    every = (n - 2) / (max_points - 2)
+    bounds = [(int(i * every) + 1, int((i + 1) * every) + 1) for i in range(max_points - 2)]
+    # 浮動小数点の丸めで末尾の手前の点が漏れないよう、最後のバケットは必ず n - 1 で閉じる
+    bounds[-1] = (bounds[-1][0], n - 1)
+    selected = {0, n - 1}; a = 0
+    for i, (start, end) in enumerate(bounds):
+        # 次のバケットの平均点と直前に選んだ点で作る三角形が最大になる点を選ぶ
+        next_start, next_end = end, (bounds[i + 1][1] if i + 1 < len(bounds) else n)
+        avg_x = x[next_start:next_end].mean(); avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area)); selected.add(a)
+    selected.update((int(np.argmax(y)), int(np.argmin(y))))
+    return sorted(selected)
+
+@instrumented("chart.radar")
+@memoize_html("チャート作成エラー")
 def create_radar_chart_html(subjects: List[str], percentages: List[float]) -> str:
-    # (元のコードから変更なし)
-    try:
-        html_content = "<div class='radar-chart'>"
-        for subject, percentage in zip(subjects, percentages):
-            if percentage >= 80: color, emoji = "#4CAF50", "🎯"
-            elif percentage >= 60: color, emoji = "#FF9800", "📈"
-            elif percentage >= 40: color, emoji = "#2196F3", "📊"
-            else: color, emoji = "#F44336", "🔥"
-            html_content += f"""<div class="radar-item" style="border-left: 4px solid {color};"><div style="font-size: 20px; margin-bottom: 5px;">{emoji}</div><div style="font-weight: bold; margin-bottom: 5px;">{subject}</div><div style="font-size: 18px; color: {color}; font-weight: bold;">{percentage:.1f}%</div></div>"""
-        return html_content + "</div>"
-    except Exception as e: return f"<div>チャート作成エラー: {e}</div>"
-
-def create_trend_chart_html(test_names: List[str], percentages: List[float]) -> str:
-    # (元のコードから変更なし)
-    try:
-        if not test_names or not percentages: return "<div>データがありません</div>"
-        html_content = "<div class='chart-container'><h4 style='text-align: center; margin-bottom: 20px;'>📈 成績推移</h4><div class='trend-chart'>"
-        for test_name, percentage in zip(test_names, percentages):
-            height = (percentage / 100) * 180
-            if percentage >= 80: color = "#4CAF50"
-            elif percentage >= 60: color = "#FF9800"
-            elif percentage >= 40: color = "#2196F3"
-            else: color = "#F44336"
-            html_content += f"""<div style="display: flex; flex-direction: column; align-items: center; margin: 0 5px;"><div class="trend-bar" style="height: {height}px; background-color: {color}; writing-mode: vertical-lr; text-orientation: mixed; padding: 5px 2px; min-width: 30px;">{percentage:.0f}%</div><div style="margin-top: 5px; font-size: 10px; text-align: center; transform: rotate(-45deg); white-space: nowrap; width: 60px;">{test_name[:8]}...</div></div>"""
-        return html_content + "</div></div>"
-    except Exception as e: return f"<div>グラフ作成エラー: {e}</div>"
+    """科目別の得点率カード (入力が同じなら描画済みのHTMLを再利用)"""
+    parts = ["<div class='radar-chart'>"]
+    for subject, percentage in zip(subjects, percentages):
+        if percentage >= 80: color, emoji = "#4CAF50", "🎯"
+        elif percentage >= 60: color, emoji = "#FF9800", "📈"
+        elif percentage >= 40: color, emoji = "#2196F3", "📊"
+        else: color, emoji = "#F44336", "🔥"
+        parts.append(f"""<div class="radar-item" style="border-left: 4px solid {color};"><div style="font-size: 20px; margin-bottom: 5px;">{emoji}</div><div style="font-weight: bold; margin-bottom: 5px;">{subject}</div><div style="font-size: 18px; color: {color}; font-weight: bold;">{percentage:.1f}%</div></div>""")
+    parts.append("</div>")
+    return "".join(parts)
+
+@instrumented("chart.trend")
+@memoize_html("グラフ作成エラー")
+def create_trend_chart_html(test_names: List[str], percentages: List[float], max_points: int = TREND_MAX_POINTS) -> str:
+    """成績推移の棒グラフ (max_points を超える分はLTTBで間引き、入力が同じなら描画済みのHTMLを再利用)"""
+    if not test_names or not percentages: return "<div>データがありません</div>"
+    kept = downsample_lttb(percentages, max_points)
+    title = "📈 成績推移" if len(kept) == len(percentages) else f"📈 成績推移 <span style='font-size: 12px; color: #888;'>(全{len(percentages)}回から{len(kept)}回分を表示)</span>"
+    parts = [f"<div class='chart-container'><h4 style='text-align: center; margin-bottom: 20px;'>{title}</h4><div class='trend-chart'>"]
+    for i in kept:
+        test_name, percentage = test_names[i], percentages[i]
+        height = (percentage / 100) * 180
+        if percentage >= 80: color = "#4CAF50"
+        elif percentage >= 60: color = "#FF9800"
+        elif percentage >= 40: color = "#2196F3"
+        else: color = "#F44336"
+        parts.append(f"""<div style="display: flex; flex-direction: column; align-items: center; margin: 0 5px;"><div class="trend-bar" style="height: {height}px; background-color: {color}; writing-mode: vertical-lr; text-orientation: mixed; padding: 5px 2px; min-width: 30px;">{percentage:.0f}%</div><div style="margin-top: 5px; font-size: 10px; text-align: center; transform: rotate(-45deg); white-space: nowrap; width: 60px;">{test_name[:8]}...</div></div>""")
+    parts.append("</div></div>")
+    return "".join(parts)
+
+# 成績分析ページの期間の選択肢 (直近何日分か、Noneは全期間)
+RESULT_PERIODS = {"全期間": None, "直近3ヶ月": 90, "直近1年": 365}
+# テスト一覧で1回に読み込むテスト数
+TEST_PAGE_SIZE = 10
+
+def load_test_page(storage_manager, test_list: dict, filters):
+    """テスト一覧の次のページ (実施日の新しい順) を読み込んで test_list に追加"""
+    page_df, cursor = storage_manager.read_page("scores", SCORE_COLUMNS, ("TestDate", "desc"), TEST_PAGE_SIZE, filters, test_list["cursor"])
+    if not page_df.empty: test_list["pages"].append(page_df)
+    test_list["cursor"] = cursor
 
 def school_registration_page():
     st.title("🎯 志望校登録/更新"); st.markdown("受験する志望校の情報を登録しましょう")
-    firestore_manager = st.session_state.firestore_manager
-    schools_df = firestore_manager.read_collection_to_df("schools", ["SchoolName", "Subjects", "MaxScores"])
+    storage_manager = st.session_state.storage_manager
+    schools_df = storage_manager.read_collection_to_df("schools", ["SchoolName", "Subjects", "MaxScores"])
     if not schools_df.empty:
         st.subheader("📋 登録済み志望校")
         for idx, row in schools_df.iterrows():
-            school_name = str(row.get("SchoolName", "Unknown")); subjects = str(row.get("Subjects", "")); max_scores = str(row.get("MaxScores", ""))
+            school_name = str(row.get("SchoolName", "Unknown")); subjects_list = row.get("Subjects"); max_scores_list = row.get("MaxScores")
             with st.expander(f"📖 {school_name}"):
-                subjects_list = [s.strip() for s in subjects.split(",") if s.strip()]; max_scores_list = [s.strip() for s in max_scores.split(",") if s.strip()]
                 col1, col2 = st.columns(2)
-                for i, (subj, max_score) in enumerate(zip(subjects_list, max_scores_list)): (col1 if i % 2 == 0 else col2).write(f"📚 **{subj}**: {max_score}点満点")
+                for i, (subj, max_score) in enumerate(zip(subjects_list, max_scores_list)): (col1 if i % 2 == 0 else col2).write(f"📚 **{subj}**: {max_score:g}点満点")
                 if st.button(f"🗑️ {school_name}を削除", key=f"delete_{idx}"):
-                    schools_df_filtered = schools_df[schools_df["SchoolName"] != school_name]
-                    if firestore_manager.save_df_to_collection(schools_df_filtered, "schools"): st.success(f"{school_name}を削除しました"); st.rerun()
+                    deleted = storage_manager.delete_school(school_name)
+                    if deleted is not None: st.session_state.pop("test_list", None); st.toast(f"{school_name}を削除しました (テスト結果を含む {deleted} 件)"); st.rerun()
     st.subheader("➕ 新しい志望校を登録"); school_name = st.text_input("🏫 学校名", key="school_name", placeholder="例：○○大学 △△学部")
     if school_name:
         st.write("📚 **受験科目を選択してください**"); selected_subjects = []
@@ -200,23 +914,20 @@ def school_registration_page():
             for i, subject in enumerate(selected_subjects): max_scores_dict[subject] = cols[i % 2].number_input(f"📝 {subject} の満点", 1, 1000, 100, 1, key=f"max_score_{subject}")
             if st.button("💾 志望校を保存", key="save_school", use_container_width=True, type="primary"):
                 try:
-                    current_schools_df = firestore_manager.read_collection_to_df("schools", ["SchoolName", "Subjects", "MaxScores"])
-                    schools_df_filtered = current_schools_df[current_schools_df["SchoolName"] != school_name]
-                    new_school = pd.DataFrame({"SchoolName": [school_name], "Subjects": [",".join(selected_subjects)], "MaxScores": [",".join(str(max_scores_dict[s]) for s in selected_subjects)]})
-                    final_df = pd.concat([schools_df_filtered, new_school], ignore_index=True)
-                    if firestore_manager.save_df_to_collection(final_df, "schools"): st.success(f"🎉 {school_name}を保存しました！"); st.balloons(); st.rerun()
-                    else: st.error("保存に失敗しました")
+                    # 画面にはすぐ反映し、保存先への書き込みはバックグラウンドで行う (同期状態はサイドバーに表示)
+                    new_school = pd.DataFrame({"SchoolName": [school_name], "Subjects": [selected_subjects], "MaxScores": [[float(max_scores_dict[s]) for s in selected_subjects]]})
+                    storage_manager.queue_upsert(new_school, "schools"); st.toast(f"🎉 {school_name}を保存しました！"); st.balloons(); st.rerun()
                 except Exception as e: st.error(f"データ処理エラー: {e}")
 
 def score_input_page():
     st.title("📝 得点入力"); st.markdown("テストの結果を記録して成績を管理しましょう")
-    firestore_manager = st.session_state.firestore_manager
-    schools_df = firestore_manager.read_collection_to_df("schools", ["SchoolName", "Subjects", "MaxScores"])
+    storage_manager = st.session_state.storage_manager
+    schools_df = storage_manager.read_collection_to_df("schools", ["SchoolName", "Subjects", "MaxScores"])
     if schools_df.empty: st.warning("⚠️ まず志望校を登録してください"); st.info("「志望校登録/更新」ページで志望校を登録できます"); return
     school_names = schools_df["SchoolName"].tolist(); selected_school = st.selectbox("🎯 志望校を選択", school_names, key="selected_school_for_score")
     if selected_school:
         school_row = schools_df[schools_df["SchoolName"] == selected_school].iloc[0]
-        subjects_list = [s.strip() for s in str(school_row.get("Subjects", "")).split(",") if s.strip()]; max_scores_list = [float(s.strip()) for s in str(school_row.get("MaxScores", "")).split(",") if s.strip()]
+        subjects_list = school_row.get("Subjects"); max_scores_list = school_row.get("MaxScores")
         if subjects_list:
             st.subheader("📋 テスト情報"); col1, col2 = st.columns(2)
             with col1: test_name = st.text_input("📝 テスト名", placeholder="例：第1回模試", key="test_name")
@@ -236,116 +947,236 @@ def score_input_page():
                 with col3: st.metric("📈 得点率", f"{total_percentage:.1f}%")
                 if st.button("💾 テスト結果を保存", key="save_test_scores", use_container_width=True, type="primary"):
                     try:
-                        scores_df = firestore_manager.read_collection_to_df("scores", ["SchoolName", "TestName", "TestDate", "Subject", "Score", "MaxScore"])
-                        scores_df_filtered = scores_df[~((scores_df['SchoolName'] == selected_school) & (scores_df['TestName'] == test_name))]
+                        # 同じテストのドキュメント (全科目) を丸ごと置き換える。書き込みはバックグラウンドで行う
                         new_scores = []
                         for subject, score in scores_dict.items(): new_scores.append({"SchoolName": selected_school, "TestName": test_name, "TestDate": str(test_date), "Subject": subject, "Score": score, "MaxScore": max_scores_list[subjects_list.index(subject)]})
-                        final_df = pd.concat([scores_df_filtered, pd.DataFrame(new_scores)], ignore_index=True)
-                        if firestore_manager.save_df_to_collection(final_df, "scores"):
-                            st.success("🎉 テスト結果を保存しました！"); st.balloons()
-                            if total_percentage >= 80: st.success("🌟 優秀！合格圏内です！")
-                            elif total_percentage >= 60: st.info("📈 良好！もう少しで合格圏内です！")
-                            elif total_percentage >= 40: st.warning("⚡ 要努力！勉強を頑張りましょう！")
-                            else: st.error("🔥 危険圏！大幅な得点アップが必要です！")
-                        else: st.error("保存に失敗しました")
+                        storage_manager.queue_upsert(pd.DataFrame(new_scores), "scores")
+                        st.session_state.pop("test_list", None)
+                        st.success("🎉 テスト結果を保存しました！"); st.balloons()
+                        if total_percentage >= 80: st.success("🌟 優秀！合格圏内です！")
+                        elif total_percentage >= 60: st.info("📈 良好！もう少しで合格圏内です！")
+                        elif total_percentage >= 40: st.warning("⚡ 要努力！勉強を頑張りましょう！")
+                        else: st.error("🔥 危険圏！大幅な得点アップが必要です！")
                     except Exception as e: st.error(f"データ処理エラー: {e}")
+    bulk_import_export_section(storage_manager, schools_df)
+
+def discard_export_file():
+    """作成済みのエクスポートファイル (一時ファイル) を削除"""
+    export_file = st.session_state.pop("export_file", None)
+    if export_file is not None:
+        try: os.remove(export_file[1])
+        except OSError: pass
+
+def bulk_import_export_section(storage_manager, schools_df: pd.DataFrame):
+    """過去の成績の一括インポート (途中から再開可能) とエクスポート"""
+    with st.expander("📥 過去の成績を一括インポート (CSV/Parquet)"):
+        st.caption("列: SchoolName, TestName, TestDate, Subject, Score (MaxScore は省略すると志望校の満点を使います)")
+        uploaded = st.file_uploader("ファイルを選択", type=["csv", "parquet"], key="bulk_import_file")
+        if uploaded is not None:
+            # 同じ内容のファイルなら、前回中断したチャンクの続きから再開する
+            digest = hashlib.sha1()
+            for block in iter(lambda: uploaded.read(1 << 20), b""): digest.update(block)
+            uploaded.seek(0)
+            state = st.session_state.setdefault("bulk_import", {}).setdefault(digest.hexdigest(), {"chunks_done": 0, "rows_imported": 0, "errors": [], "finished": False})
+            if state["chunks_done"] and not state["finished"]: st.info(f"前回は {state['rows_imported']} 行まで取り込み済みです。続きから再開します。")
+            if not state["finished"] and st.button("📥 インポート開始" if not state["chunks_done"] else "▶️ インポートを再開", key="start_bulk_import", type="primary"):
+                progress = st.progress(0.0)
+                try:
+                    for i, (chunk, fraction) in enumerate(iter_import_chunks(uploaded, uploaded.name)):
+                        if i < state["chunks_done"]: continue
+                        valid, errors = validate_chunk(chunk, schools_df)
+                        if not valid.empty: storage_manager.upsert_df(valid, "scores")
+                        state["chunks_done"] = i + 1; state["rows_imported"] += len(valid); state["errors"] = (state["errors"] + errors)[:IMPORT_MAX_ERRORS]
+                        progress.progress(fraction, text=f"{state['rows_imported']} 行を取り込みました")
+                    state["finished"] = True; st.session_state.pop("test_list", None)
+                except Exception as e: st.error(f"インポートが中断されました (もう一度押すと続きから再開します): {e}")
+            if state["finished"]: st.success(f"🎉 {state['rows_imported']} 行を取り込みました！")
+            if state["errors"]:
+                st.warning(f"⚠️ {len(state['errors'])} 行は取り込めませんでした" + (f" (最初の{IMPORT_MAX_ERRORS}件を表示)" if len(state["errors"]) >= IMPORT_MAX_ERRORS else ""))
+                st.caption("行番号は見出しの行を除いたデータの行番号です"); st.dataframe(pd.DataFrame({"エラー": state["errors"]}), use_container_width=True, hide_index=True)
+    with st.expander("📤 成績をエクスポート"):
+        export_format = st.radio("形式", ["csv", "parquet"], horizontal=True, key="export_format")
+        if st.button("📤 エクスポートファイルを作成", key="build_export"):
+            # ファイルは一時ファイルに書き出し、セッションにはパスだけを残す (メモリに全体を持たない)
+            discard_export_file()
+            out = tempfile.NamedTemporaryFile(suffix=f".{export_format}", delete=False)
+            try:
+                with out: rows = write_export(iter_export_pages(storage_manager), export_format, out)
+            except Exception: os.remove(out.name); raise
+            st.session_state.export_file = (export_format, out.name, rows)
+        if "export_file" in st.session_state:
+            export_format, path, rows = st.session_state.export_file
+            def read_export_file():
+                with open(path, "rb") as f: return f.read()
+            # ダウンロードボタンが押されたときだけ読み込む
+            st.download_button(f"⬇️ {rows} 行をダウンロード", read_export_file, file_name=f"kakomon_scores.{export_format}", mime="text/csv" if export_format == "csv" else "application/octet-stream")
 
 def results_page():
     # (元のコードからデータ読み書き部分のみ変更)
     st.title("📊 成績結果・分析"); st.markdown("あなたの成績を詳しく分析します")
-    firestore_manager = st.session_state.firestore_manager
-    scores_df = firestore_manager.read_collection_to_df("scores", ["SchoolName", "TestName", "TestDate", "Subject", "Score", "MaxScore"])
-    if scores_df.empty: st.warning("⚠️ まだテスト結果が登録されていません"); st.info("「得点入力」ページでテスト結果を登録してください"); return
-    schools = scores_df["SchoolName"].unique().tolist(); selected_school = st.selectbox("🎯 分析する志望校を選択", schools, key="result_school_select")
+    storage_manager = st.session_state.storage_manager
+    if not storage_manager.read_stats().get("TestCount"): st.warning("⚠️ まだテスト結果が登録されていません"); st.info("「得点入力」ページでテスト結果を登録してください"); return
+    schools = storage_manager.read_collection_to_df("schools", ["SchoolName"])["SchoolName"].tolist(); selected_school = st.selectbox("🎯 分析する志望校を選択", schools, key="result_school_select")
+    period = st.selectbox("📅 期間", list(RESULT_PERIODS), key="result_period")
     if selected_school:
-        school_data = scores_df[scores_df["SchoolName"] == selected_school].copy(); school_data['Score'] = pd.to_numeric(school_data['Score'], errors='coerce'); school_data['MaxScore'] = pd.to_numeric(school_data['MaxScore'], errors='coerce')
-        test_count = len(school_data["TestName"].unique()); latest_test_data = school_data.sort_values("TestDate", ascending=False)
+        # 選択中の志望校・期間の分だけを保存先で絞り込んで読み込む
+        filters = [("SchoolName", "==", selected_school)]
+        if RESULT_PERIODS[period] is not None: filters.append(("TestDate", ">=", str(date.today() - timedelta(days=RESULT_PERIODS[period]))))
+        school_data = storage_manager.read_collection_to_df("scores", SCORE_COLUMNS, filters)
+        if school_data.empty: st.info("この志望校・期間のテスト結果はまだありません"); return
+        with timed("results.analyze_school"): analysis = analyze_school(school_data)
         col1, col2, col3, col4 = st.columns(4)
         with col1: st.metric("🏫 志望校", selected_school)
-        with col2: st.metric("📝 テスト数", test_count)
+        with col2: st.metric("📝 テスト数", analysis.test_count)
         with col3:
-            if not latest_test_data.empty: st.metric("📋 最新テスト", latest_test_data.iloc[0]["TestName"])
-        with col4:
-            total_scores = [(g["Score"].sum()/g["MaxScore"].sum()*100) if g["MaxScore"].sum()>0 else 0 for _, g in school_data.groupby("TestName")]; avg_percentage = np.mean(total_scores) if total_scores else 0
-            st.metric("📈 平均得点率", f"{avg_percentage:.1f}%")
+            if analysis.latest_test is not None: st.metric("📋 最新テスト", analysis.latest_test)
+        with col4: st.metric("📈 平均得点率", f"{analysis.average_percentage:.1f}%")
         tab1, tab2, tab3 = st.tabs(["📈 成績推移", "🎯 科目別分析", "📋 テスト一覧"])
         with tab1:
             st.subheader(f"📈 {selected_school} - 成績推移")
-            test_summary = [{"テスト名":n, "日付":g["TestDate"].iloc[0], "総得点":g["Score"].sum(), "満点":g["MaxScore"].sum(), "得点率":(g["Score"].sum()/g["MaxScore"].sum()*100) if g["MaxScore"].sum()>0 else 0} for n,g in school_data.groupby("TestName")]
-            if test_summary:
-                test_summary_df = pd.DataFrame(test_summary).sort_values("日付")
-                st.markdown(create_trend_chart_html(test_summary_df["テスト名"].tolist(), test_summary_df["得点率"].tolist()), unsafe_allow_html=True)
-                st.subheader("📊 テスト結果詳細"); display_df = test_summary_df.copy(); display_df["総得点"] = display_df["総得点"].round(1).astype(str)+"/"+display_df["満点"].round(0).astype(str); display_df["得点率"] = display_df["得点率"].round(1).astype(str)+"%"; st.dataframe(display_df[["テスト名", "日付", "総得点", "得点率"]], use_container_width=True, hide_index=True)
-                if len(test_summary_df["得点率"])>=2:
-                    trend = test_summary_df["得点率"].iloc[-1]-test_summary_df["得点率"].iloc[-2]
+            test_summary_df = analysis.test_summary
+            if not test_summary_df.empty:
+                st.markdown(create_trend_chart_html(test_summary_df["TestName"].tolist(), test_summary_df["Percentage"].tolist()), unsafe_allow_html=True)
+                st.subheader("📊 テスト結果詳細"); display_df = pd.DataFrame({"テスト名": test_summary_df["TestName"], "日付": test_summary_df["TestDate"], "総得点": test_summary_df["Score"].round(1).astype(str)+"/"+test_summary_df["MaxScore"].round(0).astype(str), "得点率": test_summary_df["Percentage"].round(1).astype(str)+"%"}); st.dataframe(display_df, use_container_width=True, hide_index=True)
+                if len(test_summary_df)>=2:
+                    trend = test_summary_df["Percentage"].iloc[-1]-test_summary_df["Percentage"].iloc[-2]
                     if trend > 5: st.success(f"📈 前回より {trend:.1f}ポイント上昇！")
                     elif trend > 0: st.info(f"📊 前回より {trend:.1f}ポイント上昇。")
                     elif trend > -5: st.warning(f"📉 前回より {abs(trend):.1f}ポイント低下。")
                     else: st.error(f"⚠️ 前回より {abs(trend):.1f}ポイント大幅低下。")
         with tab2:
             st.subheader(f"🎯 {selected_school} - 科目別分析")
-            if not school_data.empty:
-                latest_test = school_data.sort_values("TestDate", ascending=False)["TestName"].iloc[0]; latest_data = school_data[school_data["TestName"] == latest_test]; subjects = latest_data["Subject"].tolist(); scores = latest_data["Score"].tolist(); max_scores = latest_data["MaxScore"].tolist(); percentages = [(s/m*100) if m>0 else 0 for s,m in zip(scores,max_scores)]; st.write(f"📝 **最新テスト: {latest_test}**"); st.markdown(create_radar_chart_html(subjects, percentages), unsafe_allow_html=True)
+            if analysis.latest_test is not None:
+                latest = analysis.latest_breakdown; st.write(f"📝 **最新テスト: {analysis.latest_test}**"); st.markdown(create_radar_chart_html(latest["Subject"].tolist(), latest["Percentage"].tolist()), unsafe_allow_html=True)
                 st.subheader("📚 科目別詳細分析")
-                for i, subject in enumerate(subjects):
+                for subject, subject_percentage in zip(latest["Subject"], latest["Percentage"]):
                     with st.expander(f"📖 {subject} の詳細"):
-                        subject_data = school_data[school_data["Subject"] == subject].sort_values("TestDate"); scores_list = subject_data["Score"].tolist()
-                        if len(scores_list)>1:
-                            st.write("**📈 得点推移:**"); st.write(" → ".join([f"{s:.1f}" for s in scores_list])); trend = scores_list[-1]-scores_list[0]
+                        trend_info = analysis.subject_trends[subject]
+                        if len(trend_info.scores)>1:
+                            st.write("**📈 得点推移:**"); st.write(" → ".join([f"{s:.1f}" for s in trend_info.scores])); trend = trend_info.change
                             if trend > 0: st.success(f"📈 初回より {trend:.1f}点向上！")
                             elif trend == 0: st.info("📊 得点は横ばいです")
                             else: st.warning(f"📉 初回より {abs(trend):.1f}点低下")
-                        c1,c2,c3,c4 = st.columns(4); c1.metric("平均点",f"{np.mean(scores_list):.1f}"); c2.metric("最高点",f"{max(scores_list):.1f}"); c3.metric("最低点",f"{min(scores_list):.1f}"); c4.metric("最新",f"{scores_list[-1]:.1f}")
-                        if percentages[i]>=80: st.success("🌟 素晴らしい成績です！")
-                        elif percentages[i]>=60: st.info("📈 良好な成績です。")
-                        elif percentages[i]>=40: st.warning("⚡ 改善の余地があります。")
+                        c1,c2,c3,c4 = st.columns(4); c1.metric("平均点",f"{trend_info.mean:.1f}"); c2.metric("最高点",f"{trend_info.maximum:.1f}"); c3.metric("最低点",f"{trend_info.minimum:.1f}"); c4.metric("最新",f"{trend_info.latest:.1f}")
+                        if subject_percentage>=80: st.success("🌟 素晴らしい成績です！")
+                        elif subject_percentage>=60: st.info("📈 良好な成績です。")
+                        elif subject_percentage>=40: st.warning("⚡ 改善の余地があります。")
                         else: st.error("🔥 基礎から見直しが必要です。")
         with tab3:
             st.subheader(f"📋 {selected_school} - テスト一覧")
-            for test_name in school_data.sort_values("TestDate", ascending=False)["TestName"].unique():
+            test_list = st.session_state.get("test_list")
+            if test_list is None or test_list["key"] != (selected_school, period):
+                test_list = st.session_state.test_list = {"key": (selected_school, period), "pages": [], "cursor": None}
+                load_test_page(storage_manager, test_list, filters)
+            with timed("results.analyze_test_list"):
+                listed = analyze_school(pd.concat(test_list["pages"], ignore_index=True)) if test_list["pages"] else analyze_school(pd.DataFrame(columns=SCORE_COLUMNS))
+                totals = listed.test_summary.set_index("TestName")
+            for test_name in listed.test_order:
                 with st.expander(f"📝 {test_name}"):
-                    test_data = school_data[school_data["TestName"] == test_name]; st.write(f"**📅 実施日**: {test_data['TestDate'].iloc[0]}")
-                    result_table = [{"科目":r["Subject"],"得点":f"{r['Score']:.1f}","満点":f"{r['MaxScore']:.0f}","得点率":f"{(r['Score']/r['MaxScore']*100 if r['MaxScore']>0 else 0):.1f}%"} for _,r in test_data.iterrows()]; st.dataframe(pd.DataFrame(result_table), use_container_width=True, hide_index=True)
-                    total_score = test_data['Score'].sum(); total_max = test_data['MaxScore'].sum(); total_percentage = (total_score/total_max*100) if total_max>0 else 0
-                    c1,c2,c3=st.columns(3); c1.metric("📊 総得点",f"{total_score:.1f}"); c2.metric("🎯 総満点",f"{total_max:.0f}"); c3.metric("📈 総合得点率",f"{total_percentage:.1f}%")
+                    test_data = listed.test_rows(test_name); test_total = totals.loc[test_name]; st.write(f"**📅 実施日**: {test_data['TestDate'].iloc[0]}")
+                    result_table = pd.DataFrame({"科目": test_data["Subject"], "得点": test_data["Score"].map("{:.1f}".format), "満点": test_data["MaxScore"].map("{:.0f}".format), "得点率": test_data["Percentage"].map("{:.1f}%".format)}); st.dataframe(result_table, use_container_width=True, hide_index=True)
+                    c1,c2,c3=st.columns(3); c1.metric("📊 総得点",f"{test_total['Score']:.1f}"); c2.metric("🎯 総満点",f"{test_total['MaxScore']:.0f}"); c3.metric("📈 総合得点率",f"{test_total['Percentage']:.1f}%")
                     st.markdown("---")
                     if st.button(f"🗑️ {test_name}を削除", key=f"delete_test_{test_name}"):
-                        all_scores_df = firestore_manager.read_collection_to_df("scores", ["SchoolName", "TestName", "TestDate", "Subject", "Score", "MaxScore"])
-                        scores_df_filtered = all_scores_df[~((all_scores_df["SchoolName"] == selected_school) & (all_scores_df["TestName"] == test_name))]
-                        if firestore_manager.save_df_to_collection(scores_df_filtered, "scores"): st.success(f"{test_name}を削除しました"); st.rerun()
+                        if storage_manager.delete_test(selected_school, test_name) is not None: st.session_state.pop("test_list", None); st.toast(f"{test_name}を削除しました"); st.rerun()
+            if test_list["cursor"] is not None and st.button("⬇️ さらに読み込む", key="load_more_tests", use_container_width=True): load_test_page(storage_manager, test_list, filters); st.rerun()
+
+# 同期待ちの間、サイドバーの同期状態を更新する間隔 (秒)
+SYNC_STATUS_INTERVAL_SECONDS = 2
+
+def sync_status(storage_manager, polling: bool):
+    """保存ボタンの書き込みの同期状態 (失敗時は再試行・破棄ボタンを表示)
+
+    polling (数秒ごとに再描画中) のときに同期待ちがなくなったら、書き込み後のサマリーを読み直すよう
+    キャッシュから外し、アプリ全体を再実行して再描画を止める (サイドバーの統計もそこで最新になる)。
+    """
+    status = storage_manager.writes.status()
+    if polling and not status["pending"]: storage_manager.invalidate(STATS_COLLECTION); st.rerun()
+    if status["failed"]:
+        st.error(f"⚠️ {status['failed']} 件の保存に失敗しました")
+        if status["error"]: st.caption(status["error"])
+        c1, c2 = st.columns(2)
+        if c1.button("🔁 再試行", key="retry_sync", use_container_width=True): storage_manager.writes.retry_failed(); st.rerun()
+        if c2.button("🗑️ 破棄", key="discard_sync", use_container_width=True): storage_manager.discard_queued_writes(); st.session_state.pop("test_list", None); st.rerun()
+    elif status["pending"]: st.info(f"🔄 {status['pending']} 件を同期中…")
+    else: st.caption("✅ すべて保存済み")
+
+def is_admin() -> bool:
+    """secretsの [admin] emails に含まれるユーザーか"""
+    try: return st.session_state.get("user_email", "") in st.secrets.get("admin", {}).get("emails", [])
+    except Exception: return False
+
+def debug_panel(record: dict):
+    """この再実行の計測値 (管理者のみ表示)"""
+    with st.sidebar.expander("🛠️ デバッグ: この再実行の計測"):
+        c1, c2 = st.columns(2); c1.metric("⏱️ 処理時間", f"{record['wall_ms']:.0f} ms"); c2.metric("📄 読込/書込", f"{record['docs_read']} / {record['docs_written']}")
+        st.caption(f"転送量: 読込 {record['bytes_read'] / 1024:.1f} KiB / 書込 {record['bytes_written'] / 1024:.1f} KiB")
+        if record["spans"]: st.dataframe(pd.DataFrame([{"処理": name, "回数": span["calls"], "合計 (ms)": span["ms"]} for name, span in record["spans"].items()]), use_container_width=True, hide_index=True)
+        previous = st.session_state.get("last_rerun_metrics")
+        if previous: st.caption(f"前回の再実行: {previous.get('page', '-')} {previous['wall_ms']:.0f} ms / 読込 {previous['docs_read']} / 書込 {previous['docs_written']}")
 
 def main():
+    """1回の再実行を計測しながらアプリを描画し、終了時に計測値をJSONログへ出力"""
+    start_rerun()
+    try: render_app()
+    finally: st.session_state.last_rerun_metrics = finish_rerun()
+
+def render_app():
     init_session_state()
     if "code" in st.query_params and not st.session_state.get('logged_in', False): process_oauth_callback()
-    if not st.session_state.get('logged_in', False): google_login_page(); return
-    if 'firestore_manager' not in st.session_state: st.session_state.firestore_manager = FirestoreManager(st.session_state['credentials_dict'], st.secrets["gcp"]["project_id"], st.session_state['user_id'])
+    if not st.session_state.get('logged_in', False): set_label("page", "login"); google_login_page(); return
+    # ログにはユーザーIDそのものではなくハッシュの先頭だけを出す
+    set_label("user", hashlib.sha1(str(st.session_state['user_id']).encode("utf-8")).hexdigest()[:12])
+    if 'storage_manager' not in st.session_state: st.session_state.storage_manager = create_storage_manager(st.session_state['credentials_dict'], st.session_state['user_id'])
+    if not st.session_state.get('schema_migrated', False):
+        # 保存先に接続できないときもページは表示し、次の再実行でもう一度試す
+        try: st.session_state.storage_manager.migrate_legacy_schema(); st.session_state.schema_migrated = True
+        except Exception as e: st.error(f"データ形式の更新に失敗しました (再読み込みでもう一度試します): {e}")
     
     with st.sidebar:
         st.write(f"👤 **{st.session_state.user_name}**さん"); st.write(f"📧 {st.session_state.user_email}"); st.write("---")
         page = st.selectbox("📱 ページを選択", ["🎯 志望校登録/更新", "📝 得点入力", "📊 成績結果・分析"])
         st.write("---")
         try:
-            firestore_manager = st.session_state.firestore_manager
-            scores_df = firestore_manager.read_collection_to_df("scores", ["TestName", "TestDate"])
-            schools_df = firestore_manager.read_collection_to_df("schools", ["SchoolName"])
-            st.write("📈 **あなたの統計**"); st.metric("🎯 志望校数", len(schools_df)); st.metric("📝 テスト数", len(scores_df["TestName"].unique()))
-            if not scores_df.empty:
-                latest_test = scores_df.sort_values("TestDate", ascending=False).iloc[0]
-                st.write(f"📋 **最新テスト**"); st.caption(f"{latest_test['TestName']}"); st.caption(f"実施日: {latest_test['TestDate']}")
+            storage_manager = st.session_state.storage_manager
+            stats = storage_manager.read_stats()
+            st.write("📈 **あなたの統計**"); st.metric("🎯 志望校数", stats.get("SchoolCount", 0)); st.metric("📝 テスト数", stats.get("TestCount", 0))
+            if stats.get("LatestTestName"):
+                st.write(f"📋 **最新テスト**"); st.caption(f"{stats['LatestTestName']}"); st.caption(f"実施日: {stats['LatestTestDate']}")
+            if st.button("🔄 統計を再計算", use_container_width=True):
+                try: storage_manager.rebuild_stats(); st.rerun()
+                except TimeoutError as e: st.error(str(e))
         except Exception: pass
+        # 同期状態はページ本体の保存を反映してから描画する (場所だけ先に確保)
+        sync_slot = st.container()
         st.write("---"); st.write("⚡ **クイックアクション**")
         if st.button("➕ 志望校を登録", use_container_width=True): st.session_state.page = "🎯 志望校登録/更新"
         if st.button("📝 テスト結果入力", use_container_width=True): st.session_state.page = "📝 得点入力"
         if st.button("📊 成績を分析", use_container_width=True): st.session_state.page = "📊 成績結果・分析"
         st.write("---"); st.write("ℹ️ **アプリについて**"); st.caption("高校生向け成績管理アプリ"); st.caption("バージョン: 3.0 Firebase Edition")
         st.write("---")
+        with st.expander("🗑️ アカウントデータを削除"):
+            st.caption("志望校・テスト結果をすべて削除します。元に戻せません。")
+            if st.checkbox("すべてのデータを削除することを確認しました", key="confirm_purge") and st.button("🗑️ すべて削除", use_container_width=True, type="primary"):
+                deleted = st.session_state.storage_manager.purge_account()
+                if deleted is not None:
+                    discard_export_file()
+                    for key in ("test_list", "bulk_import", "schema_migrated", "confirm_purge"): st.session_state.pop(key, None)
+                    st.toast(f"{deleted} 件のデータを削除しました"); st.rerun()
         if st.button("🚪 ログアウト", use_container_width=True, type="secondary"):
+            discard_export_file()
             for key in list(st.session_state.keys()): del st.session_state[key]
             st.success("ログアウトしました"); st.rerun()
     
-    if page == "🎯 志望校登録/更新": school_registration_page()
-    elif page == "📝 得点入力": score_input_page()
-    elif page == "📊 成績結果・分析": results_page()
+    set_label("page", page)
+    with timed(f"page.{page}"):
+        if page == "🎯 志望校登録/更新": school_registration_page()
+        elif page == "📝 得点入力": score_input_page()
+        elif page == "📊 成績結果・分析": results_page()
+    # 同期待ちがある間だけ、この部分を数秒ごとに再描画して状態を更新する
+    pending = st.session_state.storage_manager.writes.status()["pending"]
+    with sync_slot: st.fragment(sync_status, run_every=SYNC_STATUS_INTERVAL_SECONDS if pending else None)(st.session_state.storage_manager, bool(pending))
+    if is_admin(): debug_panel(current_metrics().to_dict())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,71 @@
+"""analytics.analyze_school (成績結果・分析ページの集計) のテスト"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics import SCORE_COLUMNS, analyze_school, percentage
+from benchmarks.datagen import generate_user
+
+def make_rows(rows):
+    return pd.DataFrame([dict(zip(SCORE_COLUMNS, row)) for row in rows], columns=SCORE_COLUMNS)
+
+@pytest.fixture
+def school_data():
+    # 実施日の順と行の順をわざとずらす (B が最新、C は A と B の間)
+    return make_rows([
+        ("志望校1", "A", "2024-01-10", "英語", 60, 100), ("志望校1", "A", "2024-01-10", "数学", 30, 50),
+        ("志望校1", "B", "2024-03-01", "英語", 80, 100), ("志望校1", "B", "2024-03-01", "数学", 40, 50), ("志望校1", "B", "2024-03-01", "国語", 50, 100),
+        ("志望校1", "C", "2024-02-01", "英語", 70, 100), ("志望校1", "C", "2024-02-01", "国語", 20, 100),
+    ])
+
+def test_totals_and_average(school_data):
+    analysis = analyze_school(school_data)
+    assert analysis.test_count == 3
+    assert analysis.test_summary["TestName"].tolist() == ["A", "C", "B"]
+    assert analysis.test_summary["Percentage"].tolist() == pytest.approx([60.0, 45.0, 68.0])
+    assert analysis.average_percentage == pytest.approx((60.0 + 45.0 + 68.0) / 3)
+
+def test_latest_test_and_order(school_data):
+    analysis = analyze_school(school_data)
+    assert analysis.latest_test == "B"
+    assert analysis.test_order == ["B", "C", "A"]
+    breakdown = analysis.latest_breakdown.set_index("Subject")["Percentage"]
+    assert breakdown.to_dict() == pytest.approx({"英語": 80.0, "数学": 80.0, "国語": 50.0})
+    assert analysis.test_rows("C")["Subject"].tolist() == ["英語", "国語"]
+
+def test_subject_history_is_oldest_first(school_data):
+    trends = analyze_school(school_data).subject_trends
+    assert set(trends) == {"英語", "数学", "国語"}
+    english = trends["英語"]
+    assert english.scores == [60.0, 70.0, 80.0]
+    assert (english.mean, english.maximum, english.minimum, english.latest, english.change) == pytest.approx((70.0, 80.0, 60.0, 80.0, 20.0))
+    assert trends["国語"].scores == [20.0, 50.0] and trends["国語"].change == pytest.approx(30.0)
+    assert trends["数学"].scores == [30.0, 40.0] and trends["数学"].mean == pytest.approx(35.0)
+
+def test_subjects_missing_from_latest_test_are_skipped(school_data):
+    older_only = pd.concat([school_data, make_rows([("志望校1", "A", "2024-01-10", "理科", 10, 100)])], ignore_index=True)
+    assert "理科" not in analyze_school(older_only).subject_trends
+
+def test_empty_frame():
+    analysis = analyze_school(pd.DataFrame(columns=SCORE_COLUMNS))
+    assert analysis.test_count == 0 and analysis.latest_test is None and analysis.average_percentage == 0.0
+    assert analysis.test_summary.empty and analysis.latest_breakdown.empty
+    assert analysis.subject_trends == {} and analysis.test_order == []
+
+def test_percentage_with_zero_max_score():
+    assert percentage([5, 10], [0, 20]).tolist() == [0.0, 50.0]
+
+def test_large_frame_matches_per_test_loop():
+    _, scores_df = generate_user(1, 20000)
+    assert len(scores_df) >= 60000
+    scores_df = pd.concat([scores_df] * 2, ignore_index=True).assign(SchoolName="志望校1")
+    scores_df["TestName"] = scores_df["TestName"] + np.where(scores_df.index < len(scores_df) // 2, "", "-再")
+    assert len(scores_df) >= 100000
+    analysis = analyze_school(scores_df)
+    # 元の results_page と同じくテストごとにループして計算した値と一致する
+    expected = {name: rows["Score"].sum() * 100 / rows["MaxScore"].sum() for name, rows in scores_df.groupby("TestName")}
+    assert analysis.test_count == len(expected)
+    assert analysis.average_percentage == pytest.approx(np.mean(list(expected.values())))
+    assert dict(zip(analysis.test_summary["TestName"], analysis.test_summary["Percentage"])) == pytest.approx(expected)
+    assert analysis.latest_test == "第20000回模試"
+    assert analysis.test_summary["TestDate"].is_monotonic_increasing
@@ -0,0 +1,60 @@
+"""bulk_io (成績の一括インポート・エクスポート) のテスト"""
+import io
+
+import pandas as pd
+
+from analytics import SCORE_COLUMNS
+from bulk_io import iter_import_chunks, validate_chunk, write_export
+
+SCHOOLS = pd.DataFrame({"SchoolName": ["志望校1"], "Subjects": [["英語", "数学"]], "MaxScores": [[100.0, 50.0]]})
+
+def rows(*records, with_max=True):
+    columns = SCORE_COLUMNS if with_max else SCORE_COLUMNS[:-1]
+    return pd.DataFrame([record if with_max else record[:-1] for record in records], columns=columns)
+
+def test_valid_rows_pass_and_max_score_is_filled_from_school():
+    chunk = rows(("志望校1", "第1回", "2024/4/1", "英語", 80, None), ("志望校1", "第1回", "2024/4/1", "数学", 50, 50))
+    valid, errors = validate_chunk(chunk, SCHOOLS)
+    assert errors == []
+    assert valid["MaxScore"].tolist() == [100.0, 50.0]
+    assert valid["TestDate"].tolist() == ["2024-04-01", "2024-04-01"]
+
+def test_max_score_column_can_be_omitted():
+    valid, errors = validate_chunk(rows(("志望校1", "第1回", "2024-04-01", "数学", 30, 0), with_max=False), SCHOOLS)
+    assert errors == [] and valid["MaxScore"].tolist() == [50.0]
+
+def test_invalid_rows_are_reported_with_data_row_numbers():
+    chunk = rows(
+        ("志望校1", "第1回", "2024-04-01", "英語", 80, 100),
+        ("志望校9", "第1回", "2024-04-01", "英語", 80, 100),
+        ("志望校1", "第1回", "2024-04-01", "理科", 80, 100),
+        ("志望校1", "第1回", "2024-04-01", "数学", 51, None),
+        ("志望校1", "第1回", "2024-04-01", "英語", -1, 100),
+        ("志望校1", "第1回", "2024-04-01", "英語", 80, 200),
+    )
+    valid, errors = validate_chunk(chunk, SCHOOLS)
+    assert len(valid) == 1
+    assert errors == [
+        "データ2行目: 未登録の志望校です",
+        "データ3行目: 志望校の受験科目にない科目です",
+        "データ4行目: 得点が0〜満点の範囲にありません",
+        "データ5行目: 得点が0〜満点の範囲にありません",
+        "データ6行目: 満点が志望校の設定と異なります",
+    ]
+
+def test_row_numbers_continue_across_csv_chunks():
+    csv = rows(*[("志望校1", f"第{i}回", "2024-04-01", "英語", 80 if i != 4 else 101, 100) for i in range(1, 6)]).to_csv(index=False).encode("utf-8")
+    errors = [error for chunk, _ in iter_import_chunks(io.BytesIO(csv), "scores.csv", chunk_rows=2) for error in validate_chunk(chunk, SCHOOLS)[1]]
+    # 見出しを除いた4行目 (ファイル上は5行目)
+    assert errors == ["データ4行目: 得点が0〜満点の範囲にありません"]
+
+def test_missing_required_column():
+    valid, errors = validate_chunk(pd.DataFrame({"SchoolName": ["志望校1"]}), SCHOOLS)
+    assert valid.empty and errors[0].startswith("必須の列がありません")
+
+def test_csv_export_round_trip():
+    pages = iter([rows(("志望校1", "第1回", "2024-04-01", "英語", 80.0, 100.0)), rows(("志望校1", "第2回", "2024-05-01", "数学", 40.0, 50.0))])
+    out = io.BytesIO()
+    assert write_export(pages, "csv", out) == 2
+    out.seek(0)
+    assert pd.read_csv(out)["TestName"].tolist() == ["第1回", "第2回"]
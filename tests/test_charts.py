@@ -0,0 +1,27 @@
+"""グラフのHTML生成と描画結果のキャッシュのテスト"""
+import streamlit_app
+from streamlit_app import create_trend_chart_html, memoize_html
+
+def test_trend_chart_accepts_max_points_keyword():
+    names = [f"第{i}回" for i in range(100)]; percentages = [float(i % 100) for i in range(100)]
+    html = create_trend_chart_html(names, percentages, max_points=20)
+    assert "全100回から" in html
+    # キーワード引数の値もキャッシュのキーに含める
+    assert create_trend_chart_html(names, percentages, max_points=30) != html
+    assert create_trend_chart_html(names, percentages, max_points=20) == html
+
+def test_failed_render_is_not_cached():
+    calls = []
+    @memoize_html("テストエラー")
+    def render(value):
+        calls.append(value)
+        if len(calls) == 1: raise ValueError("一時的な失敗")
+        return f"<div>{value}</div>"
+    assert render("a") == "<div>テストエラー: 一時的な失敗</div>"
+    assert render("a") == "<div>a</div>"
+    assert render("a") == "<div>a</div>" and len(calls) == 2
+
+def test_cache_is_bounded():
+    streamlit_app._chart_cache.clear()
+    for i in range(streamlit_app.CHART_CACHE_ENTRIES + 5): create_trend_chart_html(["第1回"], [float(i)])
+    assert len(streamlit_app._chart_cache) == streamlit_app.CHART_CACHE_ENTRIES
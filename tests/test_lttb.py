@@ -0,0 +1,41 @@
+"""downsample_lttb (成績推移グラフの間引き) のテスト"""
+import numpy as np
+import pytest
+
+from streamlit_app import downsample_lttb
+
+@pytest.mark.parametrize("n", [61, 64, 120, 1000])
+def test_extreme_just_before_last_point_is_kept(n):
+    # 最後のバケットが n - 2 を含まないと最高値・最低値を探すところで失敗していた
+    for value in (200.0, -200.0):
+        values = list(np.sin(np.arange(n) / 5.0)); values[n - 2] = value
+        kept = downsample_lttb(values, 60)
+        assert n - 2 in kept
+
+@pytest.mark.parametrize("n", [61, 64, 120, 1000])
+def test_every_point_belongs_to_a_bucket(n):
+    values = list(np.random.default_rng(n).normal(size=n))
+    kept = downsample_lttb(values, 60)
+    assert kept == sorted(set(kept))
+    assert kept[0] == 0 and kept[-1] == n - 1
+    assert int(np.argmax(values)) in kept and int(np.argmin(values)) in kept
+    assert 60 <= len(kept) <= 62
+
+def test_max_and_min_in_same_bucket_are_both_kept():
+    values = [50.0] * 200; values[100] = 100.0; values[101] = 0.0
+    kept = downsample_lttb(values, 10)
+    assert 100 in kept and 101 in kept
+
+def test_short_series_is_not_downsampled():
+    assert downsample_lttb([1.0, 2.0, 3.0], 60) == [0, 1, 2]
+
+@pytest.mark.parametrize("max_points", [0, 1, 2])
+def test_tiny_budget_is_clamped_to_three(max_points):
+    values = [float(v) for v in range(100)]
+    assert downsample_lttb(values, max_points) == downsample_lttb(values, 3)
+    assert len(downsample_lttb(values, max_points)) <= 5
+
+def test_nan_is_treated_as_zero():
+    values = [float("nan")] + [50.0] * 99
+    kept = downsample_lttb(values, 10)
+    assert kept[0] == 0 and kept[-1] == 99
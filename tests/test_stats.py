@@ -0,0 +1,104 @@
+"""サマリー (統計) の差分更新 (update_stats / compute_stats) のテスト"""
+import pandas as pd
+import pytest
+
+import streamlit_app
+from analytics import SCORE_COLUMNS
+from benchmarks.fake_firestore import FakeFirestoreClient
+from streamlit_app import FirestoreManager, SQLiteManager, compute_stats, update_stats
+
+def doc(name, date, school="志望校1"):
+    return {"SchoolName": school, "TestName": name, "TestDate": date}
+
+def stats_of(docs):
+    return {"SchoolCount": 1, **compute_stats("scores", docs)}
+
+def no_reload():
+    raise AssertionError("最新テストを選び直す必要はない")
+
+DOCS = {"a": doc("第1回", "2024-01-10"), "b": doc("第2回", "2024-02-10"), "c": doc("第3回", "2024-03-10"), "d": doc("第3回", "2024-03-10", "志望校2")}
+
+def newest_first(docs):
+    return lambda: iter(sorted(docs.items(), key=lambda item: item[1]["TestDate"], reverse=True))
+
+def test_compute_stats_counts_documents_per_test_name():
+    stats = compute_stats("scores", DOCS)
+    assert stats == {"TestNames": {"第1回": 1, "第2回": 1, "第3回": 2}, "TestCount": 3, "LatestTestName": "第3回", "LatestTestDate": "2024-03-10"}
+    assert compute_stats("schools", {"x": {}, "y": {}}) == {"SchoolCount": 2}
+
+def test_delete_latest_test_picks_the_next_newest():
+    remaining = {k: v for k, v in DOCS.items() if k not in ("c", "d")}
+    summary = update_stats("scores", stats_of(DOCS), {"c": DOCS["c"], "d": DOCS["d"]}, {"c": None, "d": None}, newest_first(DOCS))
+    assert summary == stats_of(remaining)
+
+def test_deleting_an_older_test_does_not_reload():
+    summary = update_stats("scores", stats_of(DOCS), {"a": DOCS["a"]}, {"a": None}, no_reload)
+    assert summary == stats_of({k: v for k, v in DOCS.items() if k != "a"})
+
+def test_redating_the_latest_test():
+    # 片方の志望校の第3回だけ日付を戻しても、もう片方が最新のまま
+    changed = {**DOCS, "c": doc("第3回", "2023-12-01")}
+    assert update_stats("scores", stats_of(DOCS), {"c": DOCS["c"]}, {"c": changed["c"]}, newest_first(changed)) == stats_of(changed)
+    # 両方戻すと第2回が最新になる
+    both = {**changed, "d": doc("第3回", "2023-12-01", "志望校2")}
+    assert update_stats("scores", stats_of(changed), {"d": changed["d"]}, {"d": both["d"]}, newest_first(both)) == stats_of(both)
+
+def test_repeated_test_names_across_schools():
+    summary = update_stats("scores", stats_of(DOCS), {"d": DOCS["d"]}, {"d": None}, newest_first(DOCS))
+    assert summary["TestNames"]["第3回"] == 1 and summary["TestCount"] == 3
+    summary = update_stats("scores", summary, {}, {"e": doc("第1回", "2020-01-01", "志望校2")}, no_reload)
+    assert summary["TestNames"] == {"第1回": 2, "第2回": 1, "第3回": 1} and summary["TestCount"] == 3
+
+def test_school_count_and_missing_summary():
+    assert update_stats("schools", {"SchoolCount": 2}, {"x": {}}, {"x": None, "y": {}, "z": {}}, no_reload) == {"SchoolCount": 3}
+    assert update_stats("scores", None, {}, {"a": DOCS["a"]}, no_reload) is None
+    assert update_stats("scores", {"SchoolCount": 1}, {}, {"a": DOCS["a"]}, no_reload) is None
+
+def score_rows(school, n_tests, start="2024-01-01"):
+    dates = pd.date_range(start, periods=n_tests, freq="2D").strftime("%Y-%m-%d")
+    return pd.DataFrame([(school, f"第{i + 1}回", dates[i], subject, 50.0, 100.0) for i in range(n_tests) for subject in ("英語", "数学")], columns=SCORE_COLUMNS)
+
+@pytest.fixture(params=["firestore", "sqlite"])
+def manager(request, monkeypatch):
+    # 書き込み上限を小さくして、チャンクに分けたコミットも通す
+    monkeypatch.setattr(streamlit_app, "BATCH_LIMIT", 4)
+    manager = FirestoreManager(None, None, "u", db=FakeFirestoreClient()) if request.param == "firestore" else SQLiteManager(":memory:", "u")
+    schools = pd.DataFrame({"SchoolName": ["志望校1", "志望校2"], "Subjects": [["英語", "数学"]] * 2, "MaxScores": [[100.0, 100.0]] * 2})
+    manager.save_df_to_collection(schools, "schools")
+    # 2校で同じテスト名を使い、実施日が重ならないよう志望校2は1日ずらす
+    manager.save_df_to_collection(pd.concat([score_rows("志望校1", 12), score_rows("志望校2", 12, "2024-01-02")], ignore_index=True), "scores")
+    manager.rebuild_stats()
+    yield manager
+    manager.writes.flush(5)
+
+def assert_consistent(manager):
+    manager.invalidate(); stored = manager.read_stats()
+    assert stored == manager.rebuild_stats()
+    return stored
+
+def test_backend_delete_latest_test(manager):
+    assert manager.delete_test("志望校2", "第12回") == 1
+    stats = assert_consistent(manager)
+    assert (stats["LatestTestName"], stats["LatestTestDate"], stats["TestNames"]["第12回"]) == ("第12回", "2024-01-23", 1)
+
+def test_backend_redate_latest_test(manager):
+    manager.upsert_df(score_rows("志望校2", 12, "2024-01-02").query("TestName == '第12回'").assign(TestDate="2023-06-01"), "scores")
+    assert assert_consistent(manager)["LatestTestDate"] == "2024-01-23"
+
+def test_backend_queued_redate(manager):
+    manager.queue_upsert(score_rows("志望校2", 12, "2024-01-02").query("TestName == '第12回'").assign(TestDate="2023-06-01"), "scores")
+    assert manager.writes.flush(5)
+    assert assert_consistent(manager)["LatestTestDate"] == "2024-01-23"
+
+def test_backend_chunked_school_delete(manager):
+    assert manager.delete_school("志望校1") == 13
+    stats = assert_consistent(manager)
+    assert stats["SchoolCount"] == 1 and stats["TestCount"] == 12 and set(stats["TestNames"].values()) == {1}
+    assert manager.delete_school("志望校2") == 13
+    stats = assert_consistent(manager)
+    assert (stats["SchoolCount"], stats["TestCount"], stats["LatestTestName"]) == (0, 0, None)
+
+def test_backend_chunked_save(manager):
+    manager.save_df_to_collection(score_rows("志望校1", 20, "2025-01-01"), "scores")
+    stats = assert_consistent(manager)
+    assert stats["TestCount"] == 20 and stats["LatestTestDate"] == "2025-02-08"
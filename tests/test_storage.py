@@ -0,0 +1,30 @@
+"""StorageManager (疑似Firestore・SQLite) のテスト"""
+import pytest
+
+from analytics import SCORE_COLUMNS
+from benchmarks.datagen import generate_user
+from benchmarks.fake_firestore import FakeFirestoreClient
+from streamlit_app import STATS_COLLECTION, STATS_DOC_ID, FirestoreManager
+
+@pytest.fixture
+def firestore():
+    client = FakeFirestoreClient(); manager = FirestoreManager(None, None, "u", db=client)
+    schools_df, scores_df = generate_user(2, 5)
+    manager.save_df_to_collection(schools_df, "schools"); manager.save_df_to_collection(scores_df, "scores"); manager.rebuild_stats()
+    manager.invalidate(); client.counters.reset()
+    yield client, manager, scores_df
+    manager.writes.flush(5)
+
+@pytest.mark.parametrize("warm", [False, True])
+def test_queue_upsert_does_not_touch_storage(firestore, warm):
+    client, manager, scores_df = firestore
+    if warm: manager.read_collection_to_df("scores", SCORE_COLUMNS); manager.read_stats(); client.counters.reset()
+    latest = scores_df[scores_df["TestDate"] == scores_df["TestDate"].max()]
+    manager.queue_upsert(latest.assign(TestDate="2000-01-01"), "scores")
+    assert client.counters.as_dict()["round_trips"] == 0
+    cached = manager._cached(manager._cache_key(STATS_COLLECTION))
+    # スナップショットとサマリーがキャッシュにあるときだけサマリーをすぐに反映する
+    assert (cached is not None) == warm
+    assert manager.writes.flush(5)
+    if warm: assert cached[STATS_DOC_ID] == manager.rebuild_stats()
+    manager.invalidate(); assert manager.read_stats() == manager.rebuild_stats()
@@ -0,0 +1,76 @@
+"""WriteBehindQueue (保存ボタンの書き込みキュー) のテスト"""
+import threading
+
+import pytest
+
+import write_behind
+from write_behind import WriteBehindQueue
+
+@pytest.fixture(autouse=True)
+def fast_timing(monkeypatch):
+    monkeypatch.setattr(write_behind, "WRITE_COALESCE_SECONDS", 0.05)
+    monkeypatch.setattr(write_behind, "WRITE_RETRY_BASE_SECONDS", 0.01)
+
+class FakeStore:
+    """commit に渡す疑似保存先 (fail_times 回だけ失敗する)"""
+    def __init__(self, fail_times: int = 0):
+        self.docs = {}; self.calls = []; self.fail_times = fail_times
+
+    def commit(self, collection_name: str, upserts: dict):
+        self.calls.append((collection_name, dict(upserts)))
+        if len(self.calls) <= self.fail_times: raise RuntimeError("unavailable")
+        self.docs.setdefault(collection_name, {}).update(upserts)
+
+def test_rapid_edits_are_merged_into_one_write():
+    store = FakeStore(); queue = WriteBehindQueue(store.commit)
+    for score in range(5): queue.put("scores", {"t1": {"Score": score}})
+    queue.put("scores", {"t2": {"Score": 9}})
+    assert queue.overlay("scores") == {"t1": {"Score": 4}, "t2": {"Score": 9}}
+    assert queue.status()["pending"] == 2
+    assert queue.flush(5)
+    assert store.calls == [("scores", {"t1": {"Score": 4}, "t2": {"Score": 9}})]
+    assert queue.status() == {"pending": 0, "failed": 0, "error": None} and queue.overlay("scores") == {}
+
+def test_retries_then_succeeds():
+    store = FakeStore(fail_times=2); queue = WriteBehindQueue(store.commit)
+    queue.put("scores", {"t1": {"Score": 1}})
+    assert queue.flush(5)
+    assert len(store.calls) == 3 and store.docs == {"scores": {"t1": {"Score": 1}}}
+    assert queue.status()["failed"] == 0
+
+def test_gives_up_into_failed_and_can_retry():
+    store = FakeStore(fail_times=write_behind.WRITE_MAX_ATTEMPTS); queue = WriteBehindQueue(store.commit)
+    queue.put("scores", {"t1": {"Score": 1}})
+    assert queue.flush(5)
+    assert len(store.calls) == write_behind.WRITE_MAX_ATTEMPTS
+    assert queue.status() == {"pending": 0, "failed": 1, "error": "unavailable"}
+    # 失敗した変更も画面には見えたままにする
+    assert queue.overlay("scores") == {"t1": {"Score": 1}}
+    queue.retry_failed()
+    assert queue.flush(5)
+    assert store.docs == {"scores": {"t1": {"Score": 1}}} and queue.status() == {"pending": 0, "failed": 0, "error": None}
+
+def test_discard_drops_pending_and_failed():
+    store = FakeStore(fail_times=write_behind.WRITE_MAX_ATTEMPTS); queue = WriteBehindQueue(store.commit)
+    queue.put("scores", {"t1": {"Score": 1}})
+    assert queue.flush(5) and queue.status()["failed"] == 1
+    store.fail_times = 0
+    queue.put("schools", {"s1": {}, "s2": {}})
+    assert queue.discard("schools", ["s1"]) == ["schools"]
+    assert queue.overlay("schools") == {"s2": {}}
+    assert sorted(queue.discard()) == ["schools", "scores"]
+    assert queue.status() == {"pending": 0, "failed": 0, "error": None}
+    assert queue.flush(5)
+    assert "schools" not in store.docs and "scores" not in store.docs
+
+def test_flush_times_out_while_a_write_is_in_flight():
+    release = threading.Event(); store = FakeStore()
+    def slow_commit(collection_name, upserts):
+        release.wait(5); store.commit(collection_name, upserts)
+    queue = WriteBehindQueue(slow_commit)
+    queue.put("scores", {"t1": {"Score": 1}})
+    assert queue.flush(0.2) is False
+    assert queue.status()["pending"] == 1
+    release.set()
+    assert queue.flush(5) is True
+    assert store.docs == {"scores": {"t1": {"Score": 1}}}
@@ -0,0 +1,111 @@
+"""保存ボタンの書き込みをバックグラウンドで行うキュー (write-behind)
+
+画面側は put() で変更をキューに入れてすぐに戻り、ワーカースレッドが少し待ってから
+同じドキュメントへの連続した変更を最新の1件にまとめて書き込む。失敗したら間隔を
+倍にしながら再試行し、上限に達した分は「失敗」として残す。
+ワーカーは st.* を呼ばない (画面への反映は各再実行で status() を読んで行う)。
+"""
+import threading
+import time
+from typing import Callable, Dict, List
+
+from instrumentation import log_event
+
+# 最初の変更から書き込みまで待つ秒数 (この間の変更はまとめて書き込む)
+WRITE_COALESCE_SECONDS = 0.3
+# 再試行の初回の待ち時間 (秒、失敗するたびに倍にする)
+WRITE_RETRY_BASE_SECONDS = 0.5
+WRITE_MAX_ATTEMPTS = 5
+
+class WriteBehindQueue:
+    """(コレクション名, ドキュメントID) ごとに最新の内容だけを保持する書き込みキュー
+
+    commit(collection_name, upserts) はワーカースレッドから呼ばれる (サマリーは commit 側で更新する)。
+    """
+    def __init__(self, commit: Callable[[str, dict], None]):
+        self._commit = commit
+        self._cond = threading.Condition()
+        self._pending: Dict[str, dict] = {}   # コレクション名 -> {ドキュメントID: データ} (未着手)
+        self._inflight: Dict[str, dict] = {}  # 書き込み中
+        self._failed: Dict[str, dict] = {}    # 再試行の上限に達したもの
+        self._worker = None
+        self.last_error = None
+
+    def put(self, collection_name: str, docs: dict):
+        """変更をキューに入れる (同じドキュメントへの未着手の変更は上書きする)"""
+        with self._cond:
+            self._pending.setdefault(collection_name, {}).update(docs)
+            for doc_id in docs: self._failed.get(collection_name, {}).pop(doc_id, None)
+            self._ensure_worker(); self._cond.notify_all()
+
+    def overlay(self, collection_name: str) -> dict:
+        """まだ保存先に反映されていない変更 (失敗・書き込み中・未着手の順に新しい)"""
+        with self._cond:
+            return {**self._failed.get(collection_name, {}), **self._inflight.get(collection_name, {}), **self._pending.get(collection_name, {})}
+
+    def status(self) -> dict:
+        """{"pending": 同期待ちの件数, "failed": 失敗した件数, "error": 最後のエラー}"""
+        with self._cond:
+            count = lambda docs: sum(len(d) for d in docs.values())
+            return {"pending": count(self._pending) + count(self._inflight), "failed": count(self._failed), "error": self.last_error}
+
+    def retry_failed(self):
+        """失敗した変更をもう一度キューに入れる"""
+        with self._cond:
+            for collection_name, docs in self._failed.items(): self._pending.setdefault(collection_name, {}).update({doc_id: doc for doc_id, doc in docs.items() if doc_id not in self._pending.get(collection_name, {})})
+            self._failed.clear(); self.last_error = None
+            self._ensure_worker(); self._cond.notify_all()
+
+    def discard(self, collection_name: str = None, doc_ids: List[str] = None) -> List[str]:
+        """未着手・失敗の変更を取り消し、取り消したコレクション名を返す (doc_ids を省略するとそのコレクションの全件、collection_name も省略すると全て)"""
+        with self._cond:
+            names = [collection_name] if collection_name is not None else list(set(self._pending) | set(self._failed))
+            for name in names:
+                for docs in (self._pending.get(name, {}), self._failed.get(name, {})):
+                    for doc_id in (list(docs) if doc_ids is None else doc_ids): docs.pop(doc_id, None)
+            if not any(self._failed.values()): self.last_error = None
+            return names
+
+    def flush(self, timeout: float = None) -> bool:
+        """未着手・書き込み中の変更がなくなるまで待つ (失敗した分は待たない)。時間切れなら False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while any(self._pending.values()) or any(self._inflight.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0: return False
+                self._cond.wait(remaining)
+            return True
+
+    def _ensure_worker(self):
+        # キューが空になるとワーカーは終了するため、セッションが終わってもスレッドは残らない
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True); self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not any(self._pending.values()): self._worker = None; self._cond.notify_all(); return
+            time.sleep(WRITE_COALESCE_SECONDS)
+            with self._cond:
+                batch = {name: docs for name, docs in self._pending.items() if docs}
+                self._pending = {}; self._inflight = batch
+            for collection_name, docs in batch.items(): self._write(collection_name, docs)
+            with self._cond:
+                self._inflight = {}; self._cond.notify_all()
+
+    def _write(self, collection_name: str, docs: dict):
+        """1コレクション分を書き込む (失敗したら間隔を倍にしながら再試行)"""
+        for attempt in range(1, WRITE_MAX_ATTEMPTS + 1):
+            start = time.perf_counter()
+            try:
+                self._commit(collection_name, docs)
+                log_event("write_behind", collection=collection_name, docs=len(docs), attempt=attempt, ms=round((time.perf_counter() - start) * 1000, 2), ok=True)
+                return
+            except Exception as e:
+                self.last_error = str(e)
+                log_event("write_behind", collection=collection_name, docs=len(docs), attempt=attempt, ms=round((time.perf_counter() - start) * 1000, 2), ok=False, error=str(e))
+                if attempt < WRITE_MAX_ATTEMPTS: time.sleep(WRITE_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+        with self._cond:
+            # 待っている間に新しい内容が put されたドキュメントは、そちらを優先する
+            failed = self._failed.setdefault(collection_name, {}); newer = self._pending.get(collection_name, {})
+            failed.update({doc_id: doc for doc_id, doc in docs.items() if doc_id not in newer})